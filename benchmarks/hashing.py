@@ -0,0 +1,115 @@
+#!/usr/bin/python
+"""Measures photo hashing throughput on a synthetic photo tree.
+
+Usage: benchmarks/hashing.py [--albums=N] [--photos=N] [--size_mb=N]
+"""
+
+import hashlib
+import imp
+import optparse
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+uploader = imp.load_source(
+    'uploader', os.path.join(SRC, 'google-picture-uploader.py'))
+
+
+def MakeTree(root, num_albums, num_photos, size):
+  block = os.urandom(1 << 16)
+  for i in range(num_albums):
+    album = os.path.join(root, 'album%03d' % i)
+    os.makedirs(album)
+    for j in range(num_photos):
+      stream = open(os.path.join(album, 'photo%04d.jpg' % j), 'wb')
+      written = 0
+      while written < size:
+        stream.write(block[:size - written])
+        written += len(block)
+      stream.close()
+
+
+def ScanAlbums(root):
+  albums = []
+  for path, files in sorted(uploader.ScanPhotoTree(root).iteritems()):
+    album = uploader.Album(None, os.path.basename(path))
+    album.path = path
+    album.files = files
+    album._ListPhotosFromDisk()
+    albums.append(album)
+  return albums
+
+
+def HashSerialSmallReads(albums):
+  """The original implementation: one thread, 128 byte reads."""
+  for album in albums:
+    for photo in album.photos.itervalues():
+      md5 = hashlib.md5()
+      md5.update(photo.key)
+      md5.update(album.album_tags.__str__())
+      stream = open(photo.path, 'rb')
+      while True:
+        data = stream.read(128)
+        if not data:
+          break
+        md5.update(data)
+      stream.close()
+      photo.checksum_tag = 'md5_%s' % md5.hexdigest()
+
+
+def HashPool(albums):
+  for album in albums:
+    uploader.g_hashers.UpdateChecksums(album.photos.values(), album.album_tags)
+
+
+def Measure(name, func, root, total_bytes):
+  albums = ScanAlbums(root)
+  start = time.time()
+  func(albums)
+  elapsed = time.time() - start
+  print '%-24s %8.1f MB/s (%.2fs)' % (
+      name, total_bytes / elapsed / (1 << 20), elapsed)
+  return dict((photo.path, photo.checksum_tag)
+              for album in albums for photo in album.photos.itervalues())
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--albums', type='int', default=8)
+  parser.add_option('--photos', type='int', default=16)
+  parser.add_option('--size_mb', type='float', default=4)
+  parser.add_option('--hash_parallelism', type='int', default=0)
+  parser.add_option('--dir', default=None,
+                    help='Where to build the synthetic tree.')
+  options, _ = parser.parse_args()
+
+  root = tempfile.mkdtemp(dir=options.dir)
+  try:
+    size = int(options.size_mb * (1 << 20))
+    MakeTree(root, options.albums, options.photos, size)
+    total_bytes = float(options.albums * options.photos * size)
+    parallelism = (options.hash_parallelism or
+                   uploader.GuessHashParallelism(root))
+    uploader.g_state = uploader.SyncState(None)
+    uploader.g_hashers = uploader.HashPool(parallelism)
+    print 'Hashing %d photos, %.1f MB total (page cache is warm).' % (
+        options.albums * options.photos, total_bytes / (1 << 20))
+    expected = Measure('serial, 128 byte reads', HashSerialSmallReads, root,
+                       total_bytes)
+    actual = Measure('pool of %d, %d KB reads' % (
+        parallelism, uploader.HASH_BLOCK_SIZE >> 10), HashPool, root,
+        total_bytes)
+    if actual != expected:
+      print 'ERROR: checksums differ.'
+      sys.exit(1)
+  finally:
+    shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+  main()
@@ -42,6 +42,7 @@ import atom.url
 import atom.http_interface
 import socket
 import base64
+import time
 import atom.http_core
 ssl_imported = False
 ssl = None
@@ -68,6 +69,23 @@ class HttpClient(atom.http_interface.GenericHttpClient):
   # Added to allow old v1 HttpClient objects to use the new 
   # http_code.HttpClient. Used in unit tests to inject a mock client.
   v2_http_client = None
+  # Keeps connections alive between requests, set to None to open a new
+  # connection per request. Shared with atom.http_core.HttpClient.
+  connection_pool = atom.http_core.HttpClient.connection_pool
+  # An atom.http_core.RetryPolicy deciding when failed requests are sent
+  # again, or None to never send them again.
+  retry_policy = None
+  # atom.http_core.TokenBucket limiting the bytes of request bodies and the
+  # requests sent per second, or None.
+  bandwidth_limit = None
+  request_rate_limit = None
+  # Compression of response and request bodies, and the atom.http_core.
+  # TransferStats counting their bytes, see atom.http_core.HttpClient.
+  accept_encoding = atom.http_core.HttpClient.accept_encoding
+  gzip_request_min_bytes = None
+  transfer_stats = None
+  # An atom.http_core.RequestMetrics recording each request, or None.
+  request_metrics = None
 
   def __init__(self, headers=None):
     self.debug = False
@@ -128,11 +146,57 @@ class HttpClient(atom.http_interface.GenericHttpClient):
       else:
         raise atom.http_interface.UnparsableUrlObject('Unable to parse url '
             'parameter because it was not a string or atom.url.Url')
-    
-    connection = self._prepare_connection(url, all_headers)
 
+    self._prepare_headers(url, all_headers)
+    policy = self.retry_policy
+    if policy is None:
+      return self._send_once(operation, url, all_headers, data)
+    tries = [0]
+    def send_once():
+      tries[0] += 1
+      return self._send_once(operation, url, all_headers, data, tries[0])
+    return policy.send(operation, send_once, atom.http_core.can_resend(data))
+
+  def _send_once(self, operation, url, all_headers, data, tries=1):
+    if self.request_rate_limit is not None:
+      self.request_rate_limit.consume(1)
+    all_headers, data = atom.http_core._prepare_body(
+        all_headers, data, self.gzip_request_min_bytes, self.transfer_stats)
+    timing = None
+    if self.request_metrics is not None:
+      timing = atom.http_core.RequestTiming(
+          self.request_metrics, operation, url.to_string(), tries,
+          int(all_headers.get('Content-Length') or 0))
+    pool = self.connection_pool
+    try:
+      if pool is None:
+        connection = self._prepare_connection(url, all_headers)
+        response = self._send_request(connection, operation, url,
+                                      all_headers, data, timing)
+      else:
+        port = url.port and int(url.port)
+        response = pool.send(
+            (url.protocol, url.host, port),
+            lambda: self._prepare_connection(url, all_headers),
+            lambda connection: self._send_request(connection, operation, url,
+                                                  all_headers, data, timing),
+            atom.http_core.can_resend(data), operation)
+    except Exception, e:
+      if timing is not None:
+        timing.finish(error=e)
+      raise
+    return atom.http_core._decode_response(response, self.transfer_stats,
+                                           timing)
+
+  def _send_request(self, connection, operation, url, all_headers, data,
+                    timing=None):
+    """Sends the request on connection and returns the server's response.
+
+    See atom.http_core.HttpClient._send_request for timing.
+    """
     if self.debug:
       connection.debuglevel = 1
+    atom.http_core._open_timed(connection, timing)
 
     connection.putrequest(operation, self._get_access_url(url), 
         skip_host=True)
@@ -160,19 +224,29 @@ class HttpClient(atom.http_interface.GenericHttpClient):
     # Send the HTTP headers.
     for header_name in all_headers:
       connection.putheader(header_name, all_headers[header_name])
+    if self.accept_encoding and 'Accept-Encoding' not in all_headers:
+      connection.putheader('Accept-Encoding', self.accept_encoding)
     connection.endheaders()
 
     # If there is data, send it in the request.
     if data:
       if isinstance(data, list):
         for data_part in data:
-          _send_data_part(data_part, connection)
+          _send_data_part(data_part, connection, self.bandwidth_limit)
       else:
-        _send_data_part(data, connection)
+        _send_data_part(data, connection, self.bandwidth_limit)
+    connection._request_sent = True
 
     # Return the HTTP Response from the server.
-    return connection.getresponse()
-    
+    response = connection.getresponse()
+    if timing is not None:
+      timing.first_byte = time.time() - timing.started
+    return response
+
+  def _prepare_headers(self, url, headers):
+    """Adds headers needed on every request, even on reused connections."""
+    pass
+
   def _prepare_connection(self, url, headers):
     if not isinstance(url, atom.url.Url):
       if isinstance(url, types.StringTypes):
@@ -205,8 +279,16 @@ class ProxiedHttpClient(HttpClient):
   'https_proxy' as "protocol://[username:password@]host:port".
   
   After connecting to the proxy server, the request is completed as in 
-  HttpClient.request.
+  HttpClient.request. HTTPS tunnels established with CONNECT are kept in the
+  connection pool and reused like direct connections.
   """
+  def _prepare_headers(self, url, headers):
+    proxy_settings = os.environ.get('%s_proxy' % url.protocol)
+    if proxy_settings and url.protocol != 'https':
+      proxy_auth = _get_proxy_auth(proxy_settings)
+      if proxy_auth:
+        headers['Proxy-Authorization'] = proxy_auth.strip()
+
   def _prepare_connection(self, url, headers):
     proxy_settings = os.environ.get('%s_proxy' % url.protocol)
     if not proxy_settings:
@@ -271,9 +353,6 @@ class ProxiedHttpClient(HttpClient):
         proxy_url = atom.url.parse_url(proxy_netloc)
         if not proxy_url.port:
           proxy_url.port = '80'
-        
-        if proxy_auth:
-          headers['Proxy-Authorization'] = proxy_auth.strip()
 
         return httplib.HTTPConnection(proxy_url.host, int(proxy_url.port))
 
@@ -342,20 +421,5 @@ def _get_proxy_net_location(proxy_settings):
     return proxy_settings
 
 
-def _send_data_part(data, connection):
-  if isinstance(data, types.StringTypes):
-    connection.send(data)
-    return
-  # Check to see if data is a file-like object that has a read method.
-  elif hasattr(data, 'read'):
-    # Read the file and send it a chunk at a time.
-    while 1:
-      binarydata = data.read(100000)
-      if binarydata == '': break
-      connection.send(binarydata)
-    return
-  else:
-    # The data object was not a file.
-    # Try to convert to a string and send the data.
-    connection.send(str(data))
-    return
+def _send_data_part(data, connection, bandwidth_limit=None):
+  atom.http_core._send_data_part(data, connection, bandwidth_limit)
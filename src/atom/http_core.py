@@ -22,11 +22,19 @@
 __author__ = 'j.s@google.com (Jeff Scudder)'
 
 
+import email.utils
+import errno
 import os
+import random
+import select
+import socket
 import StringIO
+import threading
+import time
 import urlparse
 import urllib
 import httplib
+import zlib
 ssl = None
 try:
   import ssl
@@ -48,6 +56,14 @@ class ProxyError(Error):
 
 
 MIME_BOUNDARY = 'END_OF_PART'
+# Bytes read and sent at a time when streaming a file-like body part.
+SEND_BUFFER_SIZE = 1 << 20
+# Bytes sent at a time when a bandwidth limit is set, to keep the rate smooth.
+LIMITED_SEND_SIZE = 1 << 14
+# Compressed bytes read at a time when decoding a response body.
+DECODE_READ_SIZE = 1 << 16
+# Methods a server may be sent twice without acting twice.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
 
 
 def get_headers(http_response):
@@ -415,9 +431,869 @@ def _dump_response(http_response):
   return output
 
 
+class ConnectionPool(object):
+  """Keeps idle persistent connections so later requests can reuse them.
+
+  Connections are keyed by (scheme, host, port). A connection is handed to a
+  single request at a time and is given back once its response has been read
+  completely. Connections idle for longer than idle_timeout seconds are
+  closed instead of being reused, since the server has likely dropped them,
+  and so are those the server is seen to have closed.
+  """
+
+  def __init__(self, max_idle_per_host=8, idle_timeout=30):
+    self.max_idle_per_host = max_idle_per_host
+    self.idle_timeout = idle_timeout
+    self._lock = threading.Lock()
+    self._idle = {}
+
+  def get(self, key):
+    """Returns an idle connection for key, or None if there is none."""
+    now = time.time()
+    expired = []
+    connection = None
+    self._lock.acquire()
+    try:
+      idle = self._idle.get(key, [])
+      while idle:
+        candidate, last_used = idle.pop()
+        if now - last_used < self.idle_timeout and not _is_dropped(candidate):
+          connection = candidate
+          break
+        expired.append(candidate)
+    finally:
+      self._lock.release()
+    for candidate in expired:
+      candidate.close()
+    return connection
+
+  def put(self, key, connection):
+    """Makes a connection whose response was fully read available again."""
+    self._lock.acquire()
+    try:
+      idle = self._idle.setdefault(key, [])
+      if len(idle) < self.max_idle_per_host:
+        idle.append((connection, time.time()))
+        return
+    finally:
+      self._lock.release()
+    connection.close()
+
+  def send(self, key, open_connection, send_request, can_resend=True,
+           method=None):
+    """Sends a request on an idle connection for key or on a new one.
+
+    A request failing on an idle connection, which the server may have
+    closed meanwhile, is sent again on a new connection if it failed before
+    it was completely written, so the server can't have acted on it, or if
+    method is idempotent. Otherwise the error is raised, for the caller's
+    RetryPolicy to decide.
+
+    Args:
+      key: The (scheme, host, port) the request is sent to.
+      open_connection: function returning a new httplib connection for key.
+      send_request: function which sends the request on the httplib
+          connection it is given and returns the server's response.
+      can_resend: bool False if the request can't be sent a second time, for
+          example because its body is read from a file.
+      method: str The HTTP method of the request, None if unknown, which
+          resends it only if it failed before it was completely written.
+
+    Returns:
+      The server's response. Its connection is given back to the pool once
+      the response body has been read.
+    """
+    connection = self.get(key)
+    if connection is not None:
+      try:
+        return self._send(key, connection, send_request)
+      except (socket.error, httplib.HTTPException):
+        connection.close()
+        # Once the whole request was written, the error may come from the
+        # server dropping the connection after acting on it.
+        if not can_resend or (connection._request_sent and
+                              (method or '').upper() not in
+                              IDEMPOTENT_METHODS):
+          raise
+    return self._send(key, open_connection(), send_request)
+
+  def _send(self, key, connection, send_request):
+    connection.response_class = _PooledHttpResponse
+    # Set by send_request once the request is completely written.
+    connection._request_sent = False
+    response = send_request(connection)
+    def release(response):
+      # A response closed before its end leaves unread bytes on the socket.
+      if (connection.sock is not None and not response.will_close and
+          response.complete):
+        self.put(key, connection)
+      else:
+        connection.close()
+    response._release = release
+    return response
+
+  def clear(self):
+    """Closes all idle connections."""
+    self._lock.acquire()
+    try:
+      idle, self._idle = self._idle, {}
+    finally:
+      self._lock.release()
+    for connections in idle.values():
+      for connection, last_used in connections:
+        connection.close()
+
+
+def _is_dropped(connection):
+  """True if the server closed an idle connection, which makes it readable."""
+  if connection.sock is None:
+    return True
+  try:
+    return bool(select.select([connection.sock], [], [], 0)[0])
+  except (select.error, socket.error, ValueError):
+    return True
+
+
+class _PooledHttpResponse(httplib.HTTPResponse):
+  """Gives its connection back to the pool once the body has been read."""
+  _release = None
+  _reading = False
+  # True once read() has consumed the whole body.
+  complete = False
+
+  def read(self, amt=None):
+    # httplib closes the response from read() only once the body is over.
+    self._reading = True
+    try:
+      return httplib.HTTPResponse.read(self, amt)
+    finally:
+      self._reading = False
+
+  def close(self):
+    if self._reading:
+      self.complete = True
+    httplib.HTTPResponse.close(self)
+    release, self._release = self._release, None
+    if release is not None:
+      release(self)
+
+
+class FileBody(object):
+  """A body part streamed from a file when the request is sent.
+
+  The file is opened for each send and closed right after it, so no handle
+  outlives the request, only SEND_BUFFER_SIZE bytes are held in memory, and
+  a retried request sends the file again. Where os.sendfile exists and the
+  connection is a plain TCP socket, the kernel copies the file to the socket.
+
+  read() is provided for code expecting a file handle; the file is closed
+  once it has been read to the end.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.size = os.path.getsize(path)
+    self._stream = None
+
+  def __len__(self):
+    return self.size
+
+  def read(self, size=-1):
+    if self._stream is None:
+      self._stream = open(self.path, 'rb')
+    data = self._stream.read(size)
+    if not data or size is None or size < 0:
+      self.close()
+    return data
+
+  def close(self):
+    stream, self._stream = self._stream, None
+    if stream is not None:
+      stream.close()
+
+  def send(self, connection, bandwidth_limit=None):
+    stream = open(self.path, 'rb')
+    try:
+      sock = connection.sock
+      sendfile = getattr(os, 'sendfile', None)
+      if (sendfile is not None and sock is not None and
+          bandwidth_limit is None and
+          not (ssl and isinstance(sock, ssl.SSLSocket)) and
+          not connection.debuglevel):
+        offset = 0
+        while offset < self.size:
+          sent = sendfile(sock.fileno(), stream.fileno(), offset,
+                          self.size - offset)
+          if not sent:
+            break
+          offset += sent
+        return
+      while True:
+        data = stream.read(SEND_BUFFER_SIZE)
+        if not data:
+          break
+        _send(connection, data, bandwidth_limit)
+    finally:
+      stream.close()
+
+
+class TokenBucket(object):
+  """Lets `rate' units per second through on average, shared by threads.
+
+  Up to `burst' units, by default one second worth, go through at once after
+  a pause. A larger amount goes through as soon as `burst' units are
+  available and the following callers wait for the difference. set_rate()
+  takes effect within a second, even for callers already waiting. A rate of
+  None lets everything through.
+  """
+
+  def __init__(self, rate=None, burst=None):
+    self._lock = threading.Lock()
+    self._tokens = 0.0
+    self.set_rate(rate, burst)
+
+  def set_rate(self, rate, burst=None):
+    self._lock.acquire()
+    try:
+      self.rate = rate or None
+      self.burst = burst or rate or 0
+      self._tokens = min(self._tokens, self.burst)
+      self._last = time.time()
+    finally:
+      self._lock.release()
+
+  def consume(self, amount):
+    """Waits until `amount' units may go through."""
+    while True:
+      self._lock.acquire()
+      try:
+        if self.rate is None:
+          return
+        now = time.time()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        needed = min(amount, self.burst)
+        if self._tokens >= needed:
+          self._tokens -= amount
+          return
+        wait = (needed - self._tokens) / self.rate
+      finally:
+        self._lock.release()
+      time.sleep(min(wait, 1))
+
+
+def _send(connection, data, bandwidth_limit=None):
+  """Sends data on connection, no faster than bandwidth_limit allows."""
+  if bandwidth_limit is None:
+    connection.send(data)
+    return
+  for start in range(0, len(data), LIMITED_SEND_SIZE):
+    piece = data[start:start + LIMITED_SEND_SIZE]
+    bandwidth_limit.consume(len(piece))
+    connection.send(piece)
+
+
+class TransferStats(object):
+  """Counts the bytes of request and response bodies, as sent on the wire
+  and before compression, to tell what compression saves."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.sent = 0
+    self.sent_raw = 0
+    self.received = 0
+    self.received_raw = 0
+
+  def add(self, sent=0, sent_raw=0, received=0, received_raw=0):
+    self._lock.acquire()
+    try:
+      self.sent += sent
+      self.sent_raw += sent_raw
+      self.received += received
+      self.received_raw += received_raw
+    finally:
+      self._lock.release()
+
+
+class RequestTiming(object):
+  """What happened to one request sent by an HttpClient with request_metrics.
+
+  Latencies are in seconds: dns, connect and tls are those of opening the
+  connection and are None on a reused one, first_byte and total are counted
+  from the start of the request to the response headers and to the end of
+  the response body. Bytes are those of the bodies, as sent on the wire.
+  tries is 1 for a request's first try, 2 for its first retry, and so on.
+  """
+
+  def __init__(self, metrics, method, uri, tries=1, sent=0):
+    self.metrics = metrics
+    self.method = method
+    self.uri = uri
+    self.tries = tries
+    self.started = time.time()
+    self.reused = False
+    self.dns = None
+    self.connect = None
+    self.tls = None
+    self.first_byte = None
+    self.total = None
+    self.sent = sent
+    self.received = 0
+    self.status = None
+    # Name of the exception raised instead of getting a response.
+    self.error = None
+
+  def finish(self, status=None, received=0, error=None):
+    """Records the request in metrics, once it is over."""
+    self.total = time.time() - self.started
+    self.status = status
+    self.received = received
+    if error is not None:
+      self.error = errno.errorcode.get(getattr(error, 'errno', None),
+                                       error.__class__.__name__)
+    self.metrics.record(self)
+
+
+def _open_timed(connection, timing):
+  """Opens connection unless already open, timing it in timing."""
+  if timing is None:
+    return
+  if connection.sock is not None:
+    timing.reused = getattr(connection, '_timed', False)
+    return
+  timing.reused = False
+  timing.dns = timing.connect = timing.tls = None
+  connection._timed = True
+  def create_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                        source_address=None):
+    # socket.create_connection, with DNS timed apart from the TCP connect.
+    start = time.time()
+    addresses = socket.getaddrinfo(address[0], address[1], 0,
+                                   socket.SOCK_STREAM)
+    timing.dns = time.time() - start
+    start = time.time()
+    error = socket.error('getaddrinfo returned no address')
+    for family, socktype, proto, _, sockaddr in addresses:
+      sock = socket.socket(family, socktype, proto)
+      try:
+        if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+          sock.settimeout(timeout)
+        if source_address:
+          sock.bind(source_address)
+        sock.connect(sockaddr)
+      except socket.error, e:
+        error = e
+        sock.close()
+        continue
+      timing.connect = time.time() - start
+      return sock
+    raise error
+  connection._create_connection = create_connection
+  start = time.time()
+  connection.connect()
+  if isinstance(connection, httplib.HTTPSConnection):
+    # The rest of connect() is the handshake, or for a proxied connection
+    # the CONNECT request then the handshake.
+    timing.tls = max(0, time.time() - start - (timing.dns or 0) -
+                     (timing.connect or 0))
+
+
+class _Histogram(object):
+  """Counts values in buckets of upper bounds, as Prometheus does."""
+
+  def __init__(self, bounds):
+    self.bounds = bounds
+    # The last bucket counts values above every bound.
+    self.counts = [0] * (len(bounds) + 1)
+    self.count = 0
+    self.sum = 0.0
+    self.min = None
+    self.max = None
+
+  def add(self, value):
+    if self.count:
+      self.min = min(self.min, value)
+      self.max = max(self.max, value)
+    else:
+      self.min = self.max = value
+    index = 0
+    while index < len(self.bounds) and value > self.bounds[index]:
+      index += 1
+    self.counts[index] += 1
+    self.count += 1
+    self.sum += value
+
+  def quantile(self, q):
+    """Estimates the q quantile, interpolating inside its bucket."""
+    if not self.count:
+      return None
+    return max(self.min, min(self.max, self._bucket_quantile(q)))
+
+  def _bucket_quantile(self, q):
+    rank = q * self.count
+    seen = 0
+    for index, count in enumerate(self.counts):
+      if count and seen + count >= rank:
+        if index == len(self.bounds):
+          return self.bounds[-1]
+        lower = 0
+        if index:
+          lower = self.bounds[index - 1]
+        return lower + (self.bounds[index] - lower) * (rank - seen) / count
+      seen += count
+    return self.bounds[-1]
+
+
+class _OperationMetrics(object):
+
+  def __init__(self, bounds):
+    self.requests = 0
+    self.retries = 0
+    self.reused = 0
+    self.sent = 0
+    self.received = 0
+    # Requests by status, or by exception name for those without response.
+    self.statuses = {}
+    self.latencies = dict((phase, _Histogram(bounds))
+                          for phase in RequestMetrics.phases)
+
+  def add(self, timing):
+    self.requests += 1
+    if timing.tries > 1:
+      self.retries += 1
+    if timing.reused:
+      self.reused += 1
+    self.sent += timing.sent
+    self.received += timing.received
+    status = str(timing.status or timing.error)
+    self.statuses[status] = self.statuses.get(status, 0) + 1
+    for phase in RequestMetrics.phases:
+      value = getattr(timing, phase)
+      if value is not None:
+        self.latencies[phase].add(value)
+
+
+class RequestMetrics(object):
+  """Aggregates the RequestTimings of requests, by operation.
+
+  The operation of a request is what classify(method, uri) returns, or its
+  lower case method if classify is None. Latencies are counted in
+  histograms of latency_buckets, in seconds. The aggregate is exported by
+  summary(), as a dict ready for json, and by prometheus(), in the
+  Prometheus text format.
+  """
+  latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                     10, 30, 60, 120, 300)
+  phases = ('dns', 'connect', 'tls', 'first_byte', 'total')
+
+  def __init__(self, classify=None):
+    self.classify = classify
+    self.started = time.time()
+    self._lock = threading.Lock()
+    self._operations = {}
+
+  def record(self, timing):
+    if self.classify is None:
+      operation = timing.method.lower()
+    else:
+      operation = self.classify(timing.method, timing.uri)
+    self._lock.acquire()
+    try:
+      metrics = self._operations.get(operation)
+      if metrics is None:
+        metrics = _OperationMetrics(self.latency_buckets)
+        self._operations[operation] = metrics
+      metrics.add(timing)
+    finally:
+      self._lock.release()
+
+  def summary(self):
+    """Returns counters and latency quantiles by operation, as a dict."""
+    operations = {}
+    self._lock.acquire()
+    try:
+      for operation, metrics in self._operations.iteritems():
+        latencies = {}
+        for phase, histogram in metrics.latencies.iteritems():
+          if not histogram.count:
+            continue
+          latencies[phase] = {
+              'count': histogram.count,
+              'mean': round(histogram.sum / histogram.count, 4),
+              'p50': round(histogram.quantile(0.5), 4),
+              'p90': round(histogram.quantile(0.9), 4),
+              'p99': round(histogram.quantile(0.99), 4)}
+        operations[operation] = {
+            'requests': metrics.requests,
+            'retries': metrics.retries,
+            'reused_connections': metrics.reused,
+            'bytes_sent': metrics.sent,
+            'bytes_received': metrics.received,
+            'statuses': dict(metrics.statuses),
+            'latency_seconds': latencies}
+    finally:
+      self._lock.release()
+    return {'started': self.started, 'updated': time.time(),
+            'operations': operations}
+
+  def prometheus(self, prefix='http_client'):
+    """Returns the metrics in the Prometheus text exposition format."""
+    counters = (
+        ('retries_total', 'retries', 'Requests which were retries.'),
+        ('reused_connections_total', 'reused',
+         'Requests sent on a kept alive connection.'),
+        ('sent_bytes_total', 'sent', 'Bytes of request bodies sent.'),
+        ('received_bytes_total', 'received',
+         'Bytes of response bodies received.'))
+    lines = []
+    self._lock.acquire()
+    try:
+      operations = sorted(self._operations.iteritems())
+      name = '%s_requests_total' % prefix
+      lines.append('# HELP %s Requests sent, by status or error.' % name)
+      lines.append('# TYPE %s counter' % name)
+      for operation, metrics in operations:
+        for status, count in sorted(metrics.statuses.iteritems()):
+          lines.append('%s{operation=%s,status=%s} %d' % (
+              name, _label(operation), _label(status), count))
+      for suffix, attribute, description in counters:
+        name = '%s_%s' % (prefix, suffix)
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s counter' % name)
+        for operation, metrics in operations:
+          lines.append('%s{operation=%s} %d' % (
+              name, _label(operation), getattr(metrics, attribute)))
+      name = '%s_request_duration_seconds' % prefix
+      lines.append('# HELP %s Latency of the phases of requests.' % name)
+      lines.append('# TYPE %s histogram' % name)
+      for operation, metrics in operations:
+        for phase in self.phases:
+          histogram = metrics.latencies[phase]
+          labels = 'operation=%s,phase=%s' % (_label(operation),
+                                               _label(phase))
+          cumulative = 0
+          for bound, count in zip(self.latency_buckets, histogram.counts):
+            cumulative += count
+            lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound,
+                                                       cumulative))
+          lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels,
+                                                       histogram.count))
+          lines.append('%s_sum{%s} %.6f' % (name, labels, histogram.sum))
+          lines.append('%s_count{%s} %d' % (name, labels, histogram.count))
+    finally:
+      self._lock.release()
+    return '\n'.join(lines) + '\n'
+
+
+def _label(value):
+  """Quotes a Prometheus label value."""
+  return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"').replace(
+      '\n', '\\n')
+
+
+def _prepare_body(headers, body, min_bytes, stats):
+  """Gzips a request body if worth it and counts its bytes in stats.
+
+  Only XML bodies made of strings and of at least min_bytes are compressed,
+  and never when min_bytes is None.
+
+  Args:
+    headers: dict of the request headers, copied if changed.
+    body: string or list of body parts.
+
+  Returns:
+    The headers and body to send.
+  """
+  size = int(headers.get('Content-Length') or 0)
+  if not size:
+    return headers, body
+  parts = body
+  if not isinstance(body, list):
+    parts = [body]
+  if (min_bytes is not None and size >= min_bytes and
+      'xml' in headers.get('Content-Type', '') and
+      'Content-Encoding' not in headers and
+      all(isinstance(part, str) for part in parts)):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    compressed = compressor.compress(''.join(parts)) + compressor.flush()
+    if len(compressed) < size:
+      headers = dict(headers)
+      headers['Content-Encoding'] = 'gzip'
+      headers['Content-Length'] = str(len(compressed))
+      if stats is not None:
+        stats.add(sent=len(compressed), sent_raw=size)
+      if isinstance(body, list):
+        return headers, [compressed]
+      return headers, compressed
+  if stats is not None:
+    stats.add(sent=size, sent_raw=size)
+  return headers, body
+
+
+def _decode_response(response, stats, timing=None):
+  """Wraps response to decode a gzip or deflate body and count its bytes.
+
+  The request is recorded in timing, a RequestTiming, once the body has been
+  read or the response closed.
+  """
+  encoding = (response.getheader('Content-Encoding') or '').lower()
+  if (encoding not in ('gzip', 'x-gzip', 'deflate') and stats is None and
+      timing is None):
+    return response
+  return DecodedResponse(response, encoding, stats, timing)
+
+
+class DecodedResponse(object):
+  """A response whose body is read decompressed.
+
+  Other attributes are those of the response it wraps, except that the
+  Content-Encoding and Content-Length of a compressed body are hidden.
+  """
+
+  def __init__(self, response, encoding, stats=None, timing=None):
+    self._response = response
+    self._stats = stats
+    self._timing = timing
+    # Bytes of the body as received, to record in timing.
+    self._received = 0
+    self._decoder = None
+    self._raw_deflate = False
+    self._buffer = ''
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+      # Also takes the zlib header of deflate bodies.
+      self._decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)
+      self._raw_deflate = encoding == 'deflate'
+
+  def _decompress(self, data):
+    try:
+      data = self._decoder.decompress(data)
+    except zlib.error:
+      if not self._raw_deflate:
+        raise
+      # Some servers send deflate bodies without the zlib header, which
+      # shows from their first bytes.
+      self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+      data = self._decoder.decompress(data)
+    self._raw_deflate = False
+    return data
+
+  def _read(self, amt):
+    if amt:
+      data = self._response.read(amt)
+    else:
+      data = self._response.read()
+    self._received += len(data)
+    if not data or not amt or self._response.isclosed():
+      self._finish()
+    return data
+
+  def _finish(self):
+    timing, self._timing = self._timing, None
+    if timing is not None:
+      timing.finish(self._response.status, self._received)
+
+  def read(self, amt=None):
+    if self._decoder is None:
+      data = self._read(amt)
+      if self._stats is not None and data:
+        self._stats.add(received=len(data), received_raw=len(data))
+      return data
+    while not amt or len(self._buffer) < amt:
+      data = self._read(amt and DECODE_READ_SIZE)
+      if not data:
+        self._buffer += self._decoder.flush()
+        break
+      if self._stats is not None:
+        self._stats.add(received=len(data))
+      self._buffer += self._decompress(data)
+    if amt:
+      data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+    else:
+      data, self._buffer = self._buffer, ''
+    if self._stats is not None:
+      self._stats.add(received_raw=len(data))
+    return data
+
+  def getheader(self, name, default=None):
+    if (self._decoder is not None and
+        name.lower() in ('content-encoding', 'content-length')):
+      return default
+    return self._response.getheader(name, default)
+
+  def getheaders(self):
+    headers = self._response.getheaders()
+    if self._decoder is None:
+      return headers
+    hidden = ('content-encoding', 'content-length')
+    if isinstance(headers, dict):
+      return dict((name, value) for name, value in headers.iteritems()
+                  if name.lower() not in hidden)
+    return [(name, value) for name, value in headers
+            if name.lower() not in hidden]
+
+  def close(self):
+    self._finish()
+    self._response.close()
+
+  def __getattr__(self, name):
+    return getattr(self._response, name)
+
+
+def can_resend(body_parts):
+  """True if sending the body again would send the same bytes."""
+  if not isinstance(body_parts, list):
+    body_parts = [body_parts]
+  for part in body_parts:
+    if hasattr(part, 'read') and not isinstance(part, FileBody):
+      return False
+  return True
+
+
+class RetryPolicy(object):
+  """Decides whether and when a failed request is sent again.
+
+  Failures are connection errors and responses with a status in
+  retry_statuses. A retry waits a random time up to base_delay doubled for
+  each try (full jitter), capped at max_delay, or what the server asked in a
+  Retry-After header, if at most max_retry_after.
+
+  A POST is only sent again when the server can't have acted on it: the
+  connection could not be opened, or the server refused the request with a
+  status in refused_statuses. Requests whose body can't be read twice are
+  never sent again.
+
+  Retries are paid from a budget shared by every request using the policy,
+  which each request adds budget_ratio to, up to max_budget. This bounds the
+  extra load retries put on a failing server to about budget_ratio.
+  """
+  retry_statuses = (429, 500, 502, 503, 504)
+  # Statuses telling the server did not act on the request.
+  refused_statuses = (429, 503)
+  idempotent_methods = IDEMPOTENT_METHODS
+  # Connection errors telling the request was never sent.
+  unsent_errnos = (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH)
+
+  def __init__(self, max_tries=5, base_delay=1, max_delay=60,
+               max_retry_after=300, budget_ratio=0.1, max_budget=20):
+    self.max_tries = max_tries
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.max_retry_after = max_retry_after
+    self.budget_ratio = budget_ratio
+    self.max_budget = max_budget
+    self._budget = float(max_budget)
+    self._lock = threading.Lock()
+
+  def send(self, method, send_request, can_resend=True):
+    """Calls send_request until it gives a response not worth retrying.
+
+    Args:
+      method: str The HTTP method of the request.
+      send_request: function which sends the request and returns the
+          server's response.
+      can_resend: bool False if the request's body can't be sent twice.
+
+    Returns:
+      The last response. Raises the last connection error if there was no
+      response.
+    """
+    self._refill()
+    tries = 0
+    while True:
+      tries += 1
+      retry = can_resend and tries < self.max_tries
+      try:
+        response = send_request()
+      except (socket.error, httplib.HTTPException), e:
+        if not (retry and self._may_resend_after_error(method, e) and
+                self._spend()):
+          raise
+        delay = self._backoff(tries)
+      else:
+        if not (retry and self._may_resend_after_status(method,
+                                                        response.status)):
+          return response
+        delay = self._retry_after(response)
+        if delay is None:
+          delay = self._backoff(tries)
+        if delay > self.max_retry_after or not self._spend():
+          return response
+        # Reading the body lets the connection be reused.
+        response.read()
+      time.sleep(delay)
+
+  def _may_resend_after_error(self, method, error):
+    if method.upper() in self.idempotent_methods:
+      return True
+    return (isinstance(error, socket.gaierror) or
+            getattr(error, 'errno', None) in self.unsent_errnos)
+
+  def _may_resend_after_status(self, method, status):
+    if method.upper() in self.idempotent_methods:
+      return status in self.retry_statuses
+    return status in self.refused_statuses
+
+  def _backoff(self, tries):
+    return random.uniform(
+        0, min(self.max_delay, self.base_delay * 2 ** (tries - 1)))
+
+  def _retry_after(self, response):
+    """Returns the seconds the Retry-After header asks for, if any."""
+    value = response.getheader('Retry-After')
+    if not value:
+      return None
+    value = value.strip()
+    if value.isdigit():
+      return int(value)
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+      return None
+    return max(0, email.utils.mktime_tz(date) - time.time())
+
+  def _refill(self):
+    self._lock.acquire()
+    try:
+      self._budget = min(self.max_budget, self._budget + self.budget_ratio)
+    finally:
+      self._lock.release()
+
+  def _spend(self):
+    self._lock.acquire()
+    try:
+      if self._budget < 1:
+        return False
+      self._budget -= 1
+      return True
+    finally:
+      self._lock.release()
+
+
 class HttpClient(object):
-  """Performs HTTP requests using httplib."""
+  """Performs HTTP requests using httplib.
+
+  Connections are kept alive in connection_pool, which is shared by all
+  clients. Set connection_pool to None to open a new connection per request.
+  Failed requests are retried as decided by retry_policy, a RetryPolicy, if
+  it is set. Set bandwidth_limit to a TokenBucket to limit the bytes of
+  request bodies sent per second, and request_rate_limit to one to limit
+  the requests sent per second.
+
+  Responses are asked for gzip or deflate compression as set in
+  accept_encoding and are decoded transparently. XML request bodies of at
+  least gzip_request_min_bytes are sent gzipped, if it is set. Bytes are
+  counted in transfer_stats, a TransferStats, if it is set, and each request
+  is timed and recorded in request_metrics, a RequestMetrics, if it is set.
+  """
   debug = None
+  connection_pool = ConnectionPool()
+  retry_policy = None
+  bandwidth_limit = None
+  request_rate_limit = None
+  accept_encoding = 'gzip, deflate'
+  gzip_request_min_bytes = None
+  transfer_stats = None
+  request_metrics = None
 
   def request(self, http_request):
     return self._http_request(http_request.method, http_request.uri,
@@ -461,10 +1337,54 @@ class HttpClient(object):
     if isinstance(uri, (str, unicode)):
       uri = Uri.parse_uri(uri)
 
-    connection = self._get_connection(uri, headers=headers)
-
+    policy = self.retry_policy
+    if policy is None:
+      return self._send_once(method, uri, headers, body_parts)
+    tries = [0]
+    def send_once():
+      tries[0] += 1
+      return self._send_once(method, uri, headers, body_parts, tries[0])
+    return policy.send(method, send_once, can_resend(body_parts))
+
+  def _send_once(self, method, uri, headers, body_parts, tries=1):
+    if self.request_rate_limit is not None:
+      self.request_rate_limit.consume(1)
+    headers, body_parts = _prepare_body(
+        headers or {}, body_parts, self.gzip_request_min_bytes,
+        self.transfer_stats)
+    timing = None
+    if self.request_metrics is not None:
+      timing = RequestTiming(self.request_metrics, method, str(uri), tries,
+                             int(headers.get('Content-Length') or 0))
+    pool = self.connection_pool
+    try:
+      if pool is None:
+        connection = self._get_connection(uri, headers=headers)
+        response = self._send_request(connection, method, uri, headers,
+                                      body_parts, timing)
+      else:
+        response = pool.send(
+            (uri.scheme, uri.host, uri.port),
+            lambda: self._get_connection(uri, headers=headers),
+            lambda connection: self._send_request(connection, method, uri,
+                                                  headers, body_parts, timing),
+            can_resend(body_parts), method)
+    except Exception, e:
+      if timing is not None:
+        timing.finish(error=e)
+      raise
+    return _decode_response(response, self.transfer_stats, timing)
+
+  def _send_request(self, connection, method, uri, headers, body_parts,
+                    timing=None):
+    """Sends the request on connection and returns the server's response.
+
+    Opening the connection and waiting for the response are timed in
+    timing, a RequestTiming, if given.
+    """
     if self.debug:
       connection.debuglevel = 1
+    _open_timed(connection, timing)
 
     if connection.host != uri.host:
       connection.putrequest(method, str(uri))
@@ -490,34 +1410,43 @@ class HttpClient(object):
     # Send the HTTP headers.
     for header_name, value in headers.iteritems():
       connection.putheader(header_name, value)
+    if self.accept_encoding and 'Accept-Encoding' not in headers:
+      connection.putheader('Accept-Encoding', self.accept_encoding)
     connection.endheaders()
 
     # If there is data, send it in the request.
     if body_parts and filter(lambda x: x != '', body_parts):
       for part in body_parts:
-        _send_data_part(part, connection)
+        _send_data_part(part, connection, self.bandwidth_limit)
+    connection._request_sent = True
 
     # Return the HTTP Response from the server.
-    return connection.getresponse()
+    response = connection.getresponse()
+    if timing is not None:
+      timing.first_byte = time.time() - timing.started
+    return response
 
 
-def _send_data_part(data, connection):
+def _send_data_part(data, connection, bandwidth_limit=None):
   if isinstance(data, (str, unicode)):
     # I might want to just allow str, not unicode.
-    connection.send(data)
+    _send(connection, data, bandwidth_limit)
+    return
+  elif isinstance(data, FileBody):
+    data.send(connection, bandwidth_limit)
     return
   # Check to see if data is a file-like object that has a read method.
   elif hasattr(data, 'read'):
     # Read the file and send it a chunk at a time.
     while 1:
-      binarydata = data.read(100000)
+      binarydata = data.read(SEND_BUFFER_SIZE)
       if binarydata == '': break
-      connection.send(binarydata)
+      _send(connection, binarydata, bandwidth_limit)
     return
   else:
     # The data object was not a file.
     # Try to convert to a string and send the data.
-    connection.send(str(data))
+    _send(connection, str(data), bandwidth_limit)
     return
 
 
@@ -25,6 +25,7 @@ __author__ = 'j.s@google.com (Jeffrey Scudder)'
 
 import os
 import atom
+import atom.http_core
 try:
   from xml.etree import cElementTree as ElementTree
 except ImportError:
@@ -98,9 +99,12 @@ class MediaSource(object):
     Args:
       file_name: string The path and file name to the file containing the media
       content_type: string A MIME type representing the type of the media
+
+    The file is only opened while it is being sent, see
+    atom.http_core.FileBody.
     """
 
-    self.file_handle = open(file_name, 'rb')
+    self.file_handle = atom.http_core.FileBody(file_name)
     self.content_type = content_type
     self.content_length = os.path.getsize(file_name)
     self.file_name = os.path.basename(file_name)
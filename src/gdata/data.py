@@ -31,6 +31,7 @@ __author__ = 'j.s@google.com (Jeff Scudder)'
 import os
 import atom.core
 import atom.data
+import atom.http_core
 
 
 GDATA_TEMPLATE = '{http://schemas.google.com/g/2005}%s'
@@ -1202,9 +1203,12 @@ class MediaSource(object):
     Args:
       file_name: string The path and file name to the file containing the media
       content_type: string A MIME type representing the type of the media
+
+    The file is only opened while it is being sent, see
+    atom.http_core.FileBody.
     """
 
-    self.file_handle = open(file_name, 'rb')
+    self.file_handle = atom.http_core.FileBody(file_name)
     self.content_type = content_type
     self.content_length = os.path.getsize(file_name)
     self.file_name = os.path.basename(file_name)
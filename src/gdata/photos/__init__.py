@@ -1098,15 +1098,68 @@ def AnyEntryFromString(xml_string):
     in GDataEntry's .FindExtensions() and extension_elements[] ).
   """
   tree = ElementTree.fromstring(xml_string)
+  return atom._CreateClassFromElementTree(_EntryClassFor(tree), tree)
+
+def _EntryClassFor(tree):
+  """Returns the *Entry class matching the kind of an entry element."""
   category = tree.find('{%s}category' % atom.ATOM_NAMESPACE)
   if category is None:
     # TODO: is this the best way to handle this?
-    return atom._CreateClassFromElementTree(GPhotosBaseEntry, tree)
+    return GPhotosBaseEntry
   namespace, kind = category.get('term').split('#')
   if namespace != PHOTOS_NAMESPACE:
     # TODO: is this the best way to handle this?
-    return atom._CreateClassFromElementTree(GPhotosBaseEntry, tree)
+    return GPhotosBaseEntry
   ## TODO: is getattr safe this way?
-  feed_class = getattr(gdata.photos, '%sEntry' % kind.title())
-  return atom._CreateClassFromElementTree(feed_class, tree)
+  return getattr(gdata.photos, '%sEntry' % kind.title())
+
+class FeedEntryStream(object):
+  """Parses a feed incrementally, yielding its entries one at a time.
+
+  The elements of each entry are dropped as soon as its object is built, so
+  memory use is bounded by the largest entry instead of the whole feed.
+  Once iteration is over, `feed' holds the feed object built from everything
+  but the entries, e.g. to read openSearch:totalResults or the next link.
+
+  Example:
+    stream = FeedEntryStream(open('album.xml'))
+    for photo in stream:
+      print photo.title.text
+    print stream.feed.total_results.text
+  """
+
+  def __init__(self, stream):
+    """stream: a file-like object with a read(size) method."""
+    self._stream = stream
+    self.feed = None
+
+  def __iter__(self):
+    entry_tag = '{%s}entry' % atom.ATOM_NAMESPACE
+    root = None
+    depth = 0
+    for event, element in ElementTree.iterparse(self._stream,
+                                                events=('start', 'end')):
+      if event == 'start':
+        if root is None:
+          root = element
+        depth += 1
+        continue
+      depth -= 1
+      if depth == 1 and element.tag == entry_tag:
+        entry = atom._CreateClassFromElementTree(_EntryClassFor(element),
+                                                 element)
+        root.remove(element)
+        yield entry
+    if root is not None:
+      self.feed = atom._CreateClassFromElementTree(_FeedClassFor(root), root)
+
+def _FeedClassFor(tree):
+  """Returns the *Feed class matching the kind of a feed element."""
+  category = tree.find('{%s}category' % atom.ATOM_NAMESPACE)
+  if category is None:
+    return GPhotosBaseFeed
+  namespace, kind = category.get('term').split('#')
+  if namespace != PHOTOS_NAMESPACE:
+    return GPhotosBaseFeed
+  return getattr(gdata.photos, '%sFeed' % kind.title())
 
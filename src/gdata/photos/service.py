@@ -81,11 +81,17 @@ __version__ = '$Revision: 176 $'[11:-2]
 
 
 import sys, os.path, StringIO
+import Queue
+import collections
+import copy
+import threading
 import time
 import gdata.service
 import gdata
 import atom.service
 import atom
+import atom.http
+import atom.http_core
 import gdata.photos
 
 SUPPORTED_UPLOAD_TYPES = ('bmp', 'jpeg', 'jpg', 'gif', 'png')
@@ -121,9 +127,105 @@ class GooglePhotosException(Exception):
         break
     self.args = [self.error_code, self.reason, self.body]
 
+class PhotosFuture(object):
+  """The pending result of a PhotosService *Async call."""
+
+  def __init__(self):
+    self._done = threading.Event()
+    self._lock = threading.Lock()
+    self._callbacks = []
+    self._result = None
+    self._exc_info = None
+
+  def done(self):
+    return self._done.isSet()
+
+  def result(self, timeout=None):
+    """Waits for the call to finish, then returns its result or raises its
+    exception. Raises RuntimeError if timeout seconds elapsed first."""
+    self._done.wait(timeout)
+    if not self._done.isSet():
+      raise RuntimeError('Timed out waiting for PhotosService call')
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+  def exception(self, timeout=None):
+    try:
+      self.result(timeout)
+    except RuntimeError:
+      raise
+    except Exception, e:
+      return e
+    return None
+
+  def add_done_callback(self, callback):
+    """Calls callback(future) once done, right away if already done."""
+    self._lock.acquire()
+    try:
+      if not self._done.isSet():
+        self._callbacks.append(callback)
+        return
+    finally:
+      self._lock.release()
+    callback(self)
+
+  def _set(self, result=None, exc_info=None):
+    self._lock.acquire()
+    try:
+      self._result = result
+      self._exc_info = exc_info
+      self._done.set()
+      callbacks, self._callbacks = self._callbacks, []
+    finally:
+      self._lock.release()
+    for callback in callbacks:
+      callback(self)
+
+
+class _AsyncWorkers(object):
+  """A fixed set of threads running queued PhotosService calls.
+
+  The queue holds at most max_pending calls, so producers block instead of
+  queueing an unbounded amount of work.
+  """
+
+  def __init__(self, num_threads, max_pending):
+    self._calls = Queue.Queue(max_pending)
+    for i in range(num_threads):
+      thread = threading.Thread(target=self._Run)
+      thread.daemon = True
+      thread.start()
+
+  def _Run(self):
+    while True:
+      future, func, args, kwargs = self._calls.get()
+      try:
+        result = func(*args, **kwargs)
+      except Exception:
+        future._set(exc_info=sys.exc_info())
+      else:
+        future._set(result=result)
+
+  def Submit(self, func, *args, **kwargs):
+    future = PhotosFuture()
+    self._calls.put((future, func, args, kwargs))
+    return future
+
+
 class PhotosService(gdata.service.GDataService):
   ssl = True
   userUri = '/data/feed/api/user/%s'
+  # Number of threads and queue size used by the *Async methods.
+  async_threads = 16
+  async_max_pending = 256
+  # Most operations the server accepts in a single batch request.
+  batch_size = 100
+  # Bytes sent per request by InsertPhotoResumable.
+  resumable_chunk_size = 8 << 20
+  # Requests in a row without progress after which InsertPhotoResumable
+  # gives up.
+  resumable_max_stalls = 3
   
   def __init__(self, email=None, password=None, source=None,
                server='picasaweb.google.com', additional_headers=None,
@@ -145,6 +247,10 @@ class PhotosService(gdata.service.GDataService):
     gdata.service.GDataService.__init__(
         self, email=email, password=password, service='lh2', source=source,
         server=server, additional_headers=additional_headers, **kwargs)
+    # Every request is retried on transient failures, see
+    # atom.http_core.RetryPolicy.
+    if isinstance(self.http_client, atom.http.HttpClient):
+      self.http_client.retry_policy = atom.http_core.RetryPolicy()
 
   def GetFeed(self, uri, limit=None, start_index=None):
     """Get a feed.
@@ -179,6 +285,88 @@ class PhotosService(gdata.service.GDataService):
     except gdata.service.RequestError, e:
       raise GooglePhotosException(e.args[0])
 
+  def GetFeedEntries(self, uri, page_size=None, prefetch=4, run=None):
+    """Yield the entries of every page of a feed.
+
+    When the first page tells how many results there are
+    (openSearch:totalResults), up to `prefetch' of the following pages are
+    fetched in parallel with GetFeedAsync. Otherwise `next' links are followed
+    one page at a time. Entries are yielded in feed order as pages arrive, so
+    only a few pages of the feed are held in memory at once.
+
+    Arguments:
+    uri: the uri of the feed, as for GetFeed
+    page_size (optional): the number of entries per page. Defaults to what
+      the server returns.
+    prefetch (optional): how many pages may be requested ahead.
+    run (optional): called as run(func, *args, **kwargs) to request each
+      page, returning what func does, e.g. to bound requests in flight. func
+      returns the feed and the list of its entries. Defaults to calling func.
+
+    Returns:
+    A generator of gdata.photos.*Entry
+
+    Raises:
+    GooglePhotosException
+    """
+    if run is None:
+      run = lambda func, *args, **kwargs: func(*args, **kwargs)
+    feed, entries = run(self._GetFeedPage, uri, limit=page_size)
+    for entry in entries:
+      yield entry
+    # The server may cap page_size, so use the size of the first page.
+    per_page = len(entries)
+    if feed.total_results is None or not per_page:
+      next_link = feed.GetNextLink()
+      while next_link is not None and next_link.href:
+        feed, entries = run(self._GetFeedPage, next_link.href)
+        for entry in entries:
+          yield entry
+        next_link = feed.GetNextLink()
+      return
+    first = 1
+    if feed.start_index is not None:
+      first = int(feed.start_index.text)
+    pages = collections.deque()
+    for start_index in range(first + per_page,
+                             int(feed.total_results.text) + 1, per_page):
+      pages.append(self._RunAsync(run, self._GetFeedPage, uri,
+                                  limit=per_page, start_index=start_index))
+      if len(pages) > prefetch:
+        for entry in pages.popleft().result()[1]:
+          yield entry
+    while pages:
+      for entry in pages.popleft().result()[1]:
+        yield entry
+
+  def _GetFeedStream(self, uri, limit=None, start_index=None,
+                     redirects_remaining=4):
+    """Requests a feed and returns the response to parse it from."""
+    if limit is not None:
+      uri = _AddQueryParam(uri, 'max-results', limit)
+    if start_index is not None:
+      uri = _AddQueryParam(uri, 'start-index', start_index)
+    response = self.ConditionalGet(uri)
+    if response.status == 200:
+      return response
+    body = response.read()
+    if response.status == 302 and redirects_remaining > 0:
+      location = (response.getheader('Location')
+                  or response.getheader('location'))
+      if location is not None:
+        return self._GetFeedStream(location,
+                                   redirects_remaining=redirects_remaining - 1)
+    raise GooglePhotosException({'status': response.status,
+                                 'reason': response.reason or '',
+                                 'body': body})
+
+  def _GetFeedPage(self, uri, limit=None, start_index=None):
+    """Requests a feed and returns it with the list of its entries."""
+    stream = gdata.photos.FeedEntryStream(
+        self._GetFeedStream(uri, limit, start_index))
+    entries = list(stream)
+    return stream.feed, entries
+
   def GetEntry(self, uri, limit=None, start_index=None):
     """Get an Entry.
 
@@ -395,27 +583,8 @@ class PhotosService(gdata.service.GDataService):
         'reason':'Accepted content types: %s' % \
           ['image/'+t for t in SUPPORTED_UPLOAD_TYPES]
         })
-    if isinstance(filename_or_handle, (str, unicode)) and \
-      os.path.exists(filename_or_handle): # it's a file name
-      mediasource = gdata.MediaSource()
-      mediasource.setFile(filename_or_handle, content_type)
-    elif hasattr(filename_or_handle, 'read'):# it's a file-like resource
-      if hasattr(filename_or_handle, 'seek'):
-        filename_or_handle.seek(0) # rewind pointer to the start of the file
-      # gdata.MediaSource needs the content length, so read the whole image 
-      file_handle = StringIO.StringIO(filename_or_handle.read()) 
-      name = 'image'
-      if hasattr(filename_or_handle, 'name'):
-        name = filename_or_handle.name
-      mediasource = gdata.MediaSource(file_handle, content_type,
-        content_length=file_handle.len, file_name=name)
-    else: #filename_or_handle is not valid
-      raise GooglePhotosException({'status':GPHOTOS_INVALID_ARGUMENT,
-        'body':'`filename_or_handle` must be a path name or a file-like object',
-        'reason':'Found %s, not path name or object with a .read() method' % \
-          filename_or_handle
-        })
-    
+    mediasource = _MediaSourceFor(filename_or_handle, content_type)
+
     if isinstance(album_or_uri, (str, unicode)): # it's a uri
       feed_uri = album_or_uri
     elif hasattr(album_or_uri, 'GetFeedLink'): # it's a AlbumFeed object
@@ -428,7 +597,8 @@ class PhotosService(gdata.service.GDataService):
       raise GooglePhotosException(e.args[0])
   
   def InsertPhotoSimple(self, album_or_uri, title, summary, filename_or_handle,
-      content_type='image/jpeg', keywords=None):
+      content_type='image/jpeg', keywords=None, checksum=None,
+      resumable=False, session_uri=None, on_progress=None):
     """Add a photo without constructing a PhotoEntry.
 
     Needs authentication, see self.ClientLogin()
@@ -450,6 +620,11 @@ class PhotosService(gdata.service.GDataService):
     keywords (optional): a 1) comma separated string or 2) a python list() of
       keywords (a.k.a. tags) to add to the image.
       E.g. 1) `dog, vacation, happy' 2) ['dog', 'happy', 'vacation']
+    checksum (optional): a client-defined string stored in <gphoto:checksum>
+      and returned in photo feeds, e.g. to tell whether the image changed.
+    resumable (optional): send the image with InsertPhotoResumable, which
+      `session_uri' and `on_progress' are passed to. `filename_or_handle'
+      must then be a file name.
     
     Returns:
     The newly created gdata.photos.PhotoEntry or GooglePhotosException on errors
@@ -466,9 +641,128 @@ class PhotosService(gdata.service.GDataService):
       if isinstance(keywords, list):
         keywords = ','.join(keywords)
       metadata.media.keywords = gdata.media.Keywords(text=keywords)
+    if checksum is not None:
+      metadata.checksum = gdata.photos.Checksum(text=checksum)
+    if resumable:
+      return self.InsertPhotoResumable(album_or_uri, metadata,
+        filename_or_handle, content_type, session_uri=session_uri,
+        on_progress=on_progress)
     return self.InsertPhoto(album_or_uri, metadata, filename_or_handle,
       content_type)
 
+  def InsertPhotoResumable(self, album_or_uri, photo, filename,
+      content_type='image/jpeg', session_uri=None, on_progress=None):
+    """Add a PhotoEntry, sending the image in chunks.
+
+    Needs authentication, see self.ClientLogin()
+
+    Each request sends at most self.resumable_chunk_size bytes, so a failure
+    only loses the chunk in flight, and an upload session interrupted by a
+    failure or by exiting can be continued by a later call. The upload fails
+    once self.resumable_max_stalls requests in a row made no progress; its
+    session should then not be continued.
+
+    Arguments:
+    album_or_uri: AlbumFeed or uri of the album where the photo should go
+    photo: PhotoEntry to add
+    filename: the name of the file to read the image/video from
+    content_type (optional): see InsertPhoto
+    session_uri (optional): the upload session of an interrupted call, as
+      passed to `on_progress'. The upload continues where the server says it
+      stopped, or starts over if the session expired.
+    on_progress (optional): called as on_progress(session_uri, offset) when
+      the session starts and after every chunk, e.g. to save them to disk.
+
+    Returns:
+    The newly created gdata.photos.PhotoEntry or GooglePhotosException on errors
+    """
+
+    total = os.path.getsize(filename)
+    offset = None
+    if session_uri is not None:
+      offset, entry = self._QueryUploadSession(session_uri, total)
+      if entry is not None:
+        return entry
+    if offset is None:
+      session_uri = self._StartUploadSession(
+        _ResumableCreateUri(album_or_uri), photo, content_type, total)
+      offset = 0
+    if on_progress is not None:
+      on_progress(session_uri, offset)
+    stream = open(filename, 'rb')
+    stalls = 0
+    try:
+      while True:
+        if offset < total:
+          stream.seek(offset)
+          data = stream.read(self.resumable_chunk_size)
+          response = self.request('PUT', session_uri, data=data, headers={
+              'Content-Type': content_type,
+              'Content-Range': 'bytes %d-%d/%d' % (
+                  offset, offset + len(data) - 1, total)})
+          body = response.read()
+          if response.status in (200, 201):
+            return gdata.photos.PhotoEntryFromString(body)
+          if response.status != 308:
+            raise GooglePhotosException({'status': response.status,
+                                         'reason': response.reason or '',
+                                         'body': body})
+          uploaded = _UploadedBytes(response)
+        else:
+          # The server has every byte, only its answer is missing.
+          uploaded, entry = self._QueryUploadSession(session_uri, total)
+          if entry is not None:
+            return entry
+          if uploaded is None:
+            raise GooglePhotosException({'status': 410,
+                                         'reason': 'Upload session expired',
+                                         'body': ''})
+        if uploaded > offset:
+          stalls = 0
+        else:
+          stalls += 1
+          if stalls >= self.resumable_max_stalls:
+            raise GooglePhotosException({'status': 308,
+                                         'reason': 'Upload made no progress',
+                                         'body': ''})
+        offset = uploaded
+        if on_progress is not None:
+          on_progress(session_uri, offset)
+    finally:
+      stream.close()
+
+  def _StartUploadSession(self, uri, photo, content_type, total):
+    """Sends the photo metadata and returns the upload session uri."""
+    response = self.request('POST', uri, data=str(photo), headers={
+        'Content-Type': 'application/atom+xml',
+        'X-Upload-Content-Type': content_type,
+        'X-Upload-Content-Length': str(total)})
+    body = response.read()
+    location = (response.getheader('Location')
+                or response.getheader('location'))
+    if response.status != 200 or not location:
+      raise GooglePhotosException({'status': response.status,
+                                   'reason': response.reason or '',
+                                   'body': body})
+    return location
+
+  def _QueryUploadSession(self, session_uri, total):
+    """Returns (offset, None) to resume an upload, or (None, entry) if it
+    completed, or (None, None) if the session is gone."""
+    response = self.request('PUT', session_uri, headers={
+        'Content-Length': '0',
+        'Content-Range': 'bytes */%d' % total})
+    body = response.read()
+    if response.status in (200, 201):
+      return None, gdata.photos.PhotoEntryFromString(body)
+    if response.status == 308:
+      return _UploadedBytes(response), None
+    if response.status in (404, 410):
+      return None, None
+    raise GooglePhotosException({'status': response.status,
+                                 'reason': response.reason or '',
+                                 'body': body})
+
   def UpdatePhotoMetadata(self, photo):
     """Update a photo's metadata. 
 
@@ -505,9 +799,39 @@ class PhotosService(gdata.service.GDataService):
     except gdata.service.RequestError, e:
       raise GooglePhotosException(e.args[0])
 
-  
+  def MovePhoto(self, photo, album_id, title=None, keywords=None,
+      checksum=None):
+    """Move a photo to another album without uploading it again.
+
+    Needs authentication, see self.ClientLogin()
+
+    Arguments:
+    photo: a gdata.photos.PhotoEntry that will be moved
+    album_id: gphoto:id of the album the photo moves to, which may be its
+      current album to only change its metadata
+    title (optional): new title of the photo
+    keywords (optional): see InsertPhotoSimple, replaces existing keywords
+    checksum (optional): see InsertPhotoSimple
+
+    Returns:
+    The modified gdata.photos.PhotoEntry or GooglePhotosException on errors
+    """
+    photo.albumid = gdata.photos.Albumid(text=album_id)
+    if title is not None:
+      photo.title = atom.Title(text=title)
+    if keywords is not None:
+      if isinstance(keywords, list):
+        keywords = ','.join(keywords)
+      if photo.media is None:
+        photo.media = gdata.media.Group()
+      photo.media.keywords = gdata.media.Keywords(text=keywords)
+    if checksum is not None:
+      photo.checksum = gdata.photos.Checksum(text=checksum)
+    return self.UpdatePhotoMetadata(photo)
+
+
   def UpdatePhotoBlob(self, photo_or_uri, filename_or_handle,
-                      content_type = 'image/jpeg'):
+                      content_type = 'image/jpeg', metadata=None):
     """Update a photo's binary data.
 
     Needs authentication, see self.ClientLogin()
@@ -524,6 +848,11 @@ class PhotosService(gdata.service.GDataService):
        o image/jpeg
        o image/png
     Images will be converted to jpeg on upload. Defaults to `image/jpeg'
+    metadata (optional): a gdata.photos.PhotoEntry whose metadata replaces
+      the photo's in the same request, see UpdatePhotoMetadata
+
+    If `photo_or_uri' is an entry carrying a gd:etag, it is sent in an
+    If-Match header so the update fails if the photo changed meanwhile.
 
     Returns:
     The modified gdata.photos.PhotoEntry
@@ -547,37 +876,60 @@ class PhotosService(gdata.service.GDataService):
           ['image/'+t for t in SUPPORTED_UPLOAD_TYPES]
         })
     
-    if isinstance(filename_or_handle, (str, unicode)) and \
-      os.path.exists(filename_or_handle): # it's a file name
-      photoblob = gdata.MediaSource()
-      photoblob.setFile(filename_or_handle, content_type)
-    elif hasattr(filename_or_handle, 'read'):# it's a file-like resource
-      if hasattr(filename_or_handle, 'seek'):
-        filename_or_handle.seek(0) # rewind pointer to the start of the file
-      # gdata.MediaSource needs the content length, so read the whole image 
-      file_handle = StringIO.StringIO(filename_or_handle.read()) 
-      name = 'image'
-      if hasattr(filename_or_handle, 'name'):
-        name = filename_or_handle.name
-      mediasource = gdata.MediaSource(file_handle, content_type,
-        content_length=file_handle.len, file_name=name)
-    else: #filename_or_handle is not valid
-      raise GooglePhotosException({'status':GPHOTOS_INVALID_ARGUMENT,
-        'body':'`filename_or_handle` must be a path name or a file-like object',
-        'reason':'Found %s, not path name or an object with .read() method' % \
-          type(filename_or_handle)
-        })
-    
+    mediasource = _MediaSourceFor(filename_or_handle, content_type)
+
+    extra_headers = {}
     if isinstance(photo_or_uri, (str, unicode)):
       entry_uri = photo_or_uri # it's a uri
     elif hasattr(photo_or_uri, 'GetEditMediaLink'):
       entry_uri = photo_or_uri.GetEditMediaLink().href
+      etag = photo_or_uri.extension_attributes.get(
+          '{%s}etag' % gdata.GDATA_NAMESPACE)
+      if etag:
+        extra_headers['If-Match'] = etag
     try:
-      return self.Put(photoblob, entry_uri,
+      if metadata is not None:
+        return self.Put(metadata, entry_uri, extra_headers=extra_headers,
+            media_source=mediasource,
+            converter=gdata.photos.PhotoEntryFromString)
+      return self.Put(mediasource, entry_uri, extra_headers=extra_headers,
           converter=gdata.photos.PhotoEntryFromString)
     except gdata.service.RequestError, e:
       raise GooglePhotosException(e.args[0])
 
+  def UpdatePhotoSimple(self, photo, filename_or_handle,
+      content_type='image/jpeg', keywords=None, checksum=None):
+    """Replace a photo's image, keywords and checksum in one request.
+
+    Needs authentication, see self.ClientLogin()
+
+    The photo keeps its id, position in the album, title, summary and
+    comments.
+
+    Arguments:
+    photo: a gdata.photos.PhotoEntry that will be updated
+    filename_or_handle: A file-like object or file name where the image/video
+      will be read from
+    content_type (optional): see UpdatePhotoBlob
+    keywords (optional): see InsertPhotoSimple, replaces existing keywords
+    checksum (optional): see InsertPhotoSimple
+
+    Returns:
+    The modified gdata.photos.PhotoEntry or GooglePhotosException on errors
+    """
+
+    metadata = gdata.photos.PhotoEntry()
+    metadata.title = photo.title
+    metadata.summary = photo.summary
+    if keywords is not None:
+      if isinstance(keywords, list):
+        keywords = ','.join(keywords)
+      metadata.media.keywords = gdata.media.Keywords(text=keywords)
+    if checksum is not None:
+      metadata.checksum = gdata.photos.Checksum(text=checksum)
+    return self.UpdatePhotoBlob(photo, filename_or_handle, content_type,
+      metadata=metadata)
+
   def InsertTag(self, photo_or_uri, tag):
     """Add a tag (a.k.a. keyword) to a photo.
 
@@ -660,6 +1012,193 @@ class PhotosService(gdata.service.GDataService):
     except gdata.service.RequestError, e:
       raise GooglePhotosException(e.args[0])
 
+  def ExecuteBatch(self, batch_feed, uri,
+                   converter=gdata.BatchFeedFromString):
+    """Send a batch request feed.
+
+    Needs authentication, see self.ClientLogin()
+
+    Arguments:
+    batch_feed: a gdata.BatchFeed with the operations to perform
+    uri: the batch uri of the feed, see BatchUri
+
+    Returns:
+    The gdata.BatchFeed with one entry holding a batch:status per operation,
+    or GooglePhotosException on errors
+    """
+    try:
+      return self.Post(batch_feed, uri, converter=converter)
+    except gdata.service.RequestError, e:
+      raise GooglePhotosException(e.args[0])
+
+  def DeleteBatch(self, entries, batch_uri):
+    """Delete entries of a feed with as few requests as possible.
+
+    Needs authentication, see self.ClientLogin()
+
+    Arguments:
+    entries: the entries to delete, e.g. gdata.photos.PhotoEntry
+    batch_uri: the batch uri of the feed holding the entries, see BatchUri
+
+    Returns:
+    A list with a gdata.BatchStatus for each entry, in the same order. See
+    _RunBatch for statuses of operations the server did not perform.
+    """
+    return self._RunBatch(batch_uri, [(gdata.BATCH_DELETE, entry)
+                                      for entry in entries])
+
+  def UpdatePhotoMetadataBatch(self, photos, batch_uri):
+    """Update the metadata of many photos with as few requests as possible.
+
+    Needs authentication, see self.ClientLogin()
+
+    Arguments:
+    photos: gdata.photos.PhotoEntry objects with updated elements, see
+      UpdatePhotoMetadata
+    batch_uri: the batch uri of the album holding the photos, see BatchUri
+
+    Returns:
+    A list with a gdata.BatchStatus for each photo, in the same order. See
+    _RunBatch for statuses of operations the server did not perform.
+    """
+    return self._RunBatch(batch_uri, [(gdata.BATCH_UPDATE, photo)
+                                      for photo in photos])
+
+  def _RunBatch(self, batch_uri, operations):
+    """Sends operations in requests of up to batch_size entries.
+
+    Operations of a request that failed as a whole get the status of that
+    request, and operations the server skipped (batch:interrupted) get a
+    status with code None.
+    """
+    statuses = []
+    for first in range(0, len(operations), self.batch_size):
+      chunk = operations[first:first + self.batch_size]
+      batch_feed = gdata.BatchFeed()
+      for i, (operation, entry) in enumerate(chunk):
+        if operation == gdata.BATCH_DELETE:
+          batch_feed.AddDelete(url_string=entry.id.text,
+                               batch_id_string=str(i))
+        else:
+          batch_feed.entry.append(_BatchEntryFor(entry, operation, str(i)))
+      try:
+        result = self.ExecuteBatch(batch_feed, batch_uri)
+      except GooglePhotosException, e:
+        statuses.extend([gdata.BatchStatus(code=str(e.error_code),
+                                           reason=e.reason)] * len(chunk))
+        continue
+      by_id = {}
+      for entry in result.entry:
+        if entry.batch_id is not None and entry.batch_status is not None:
+          by_id[entry.batch_id.text] = entry.batch_status
+      for i in range(len(chunk)):
+        statuses.append(by_id.get(str(i), gdata.BatchStatus(
+            reason='Not processed by the server')))
+    return statuses
+
+  def _RunAsync(self, func, *args, **kwargs):
+    if getattr(self, '_async_workers', None) is None:
+      self._async_workers = _AsyncWorkers(self.async_threads,
+                                          self.async_max_pending)
+    return self._async_workers.Submit(func, *args, **kwargs)
+
+  def GetFeedAsync(self, uri, limit=None, start_index=None):
+    """Like GetFeed, but returns at once with a PhotosFuture.
+
+    Requests run on a fixed pool of async_threads threads sharing the
+    connection pool. At most async_max_pending requests wait in the queue,
+    further calls block until there is room.
+    """
+    return self._RunAsync(self.GetFeed, uri, limit=limit,
+                          start_index=start_index)
+
+  def InsertPhotoSimpleAsync(self, album_or_uri, title, summary,
+                             filename_or_handle, content_type='image/jpeg',
+                             keywords=None, checksum=None):
+    """Like InsertPhotoSimple, but returns at once with a PhotosFuture."""
+    return self._RunAsync(self.InsertPhotoSimple, album_or_uri, title,
+                          summary, filename_or_handle,
+                          content_type=content_type, keywords=keywords,
+                          checksum=checksum)
+
+  def DeleteAsync(self, object_or_uri, *args, **kwargs):
+    """Like Delete, but returns at once with a PhotosFuture."""
+    return self._RunAsync(self.Delete, object_or_uri, *args, **kwargs)
+
+def _MediaSourceFor(filename_or_handle, content_type):
+  """Returns a gdata.MediaSource streaming the image from a file."""
+  if isinstance(filename_or_handle, (str, unicode)) and \
+    os.path.exists(filename_or_handle): # it's a file name
+    mediasource = gdata.MediaSource()
+    mediasource.setFile(filename_or_handle, content_type)
+    return mediasource
+  if not hasattr(filename_or_handle, 'read'): #filename_or_handle is not valid
+    raise GooglePhotosException({'status':GPHOTOS_INVALID_ARGUMENT,
+      'body':'`filename_or_handle` must be a path name or a file-like object',
+      'reason':'Found %s, not path name or object with a .read() method' % \
+        filename_or_handle
+      })
+  file_handle = filename_or_handle
+  if hasattr(file_handle, 'seek'):
+    file_handle.seek(0) # rewind pointer to the start of the file
+  # gdata.MediaSource needs the content length. Only read the whole image
+  # into memory if there is no other way to tell it.
+  try:
+    content_length = os.fstat(file_handle.fileno()).st_size
+  except (AttributeError, EnvironmentError, ValueError): # not a real file
+    if hasattr(file_handle, 'seek') and hasattr(file_handle, 'tell'):
+      file_handle.seek(0, 2)
+      content_length = file_handle.tell()
+      file_handle.seek(0)
+    else:
+      file_handle = StringIO.StringIO(file_handle.read())
+      content_length = file_handle.len
+  name = getattr(filename_or_handle, 'name', 'image')
+  return gdata.MediaSource(file_handle, content_type,
+    content_length=content_length, file_name=name)
+
+
+def _ResumableCreateUri(album_or_uri):
+  """Returns where to start resumable uploads into an album."""
+  if isinstance(album_or_uri, (str, unicode)): # it's a uri
+    feed_uri = album_or_uri
+  else:
+    for link in album_or_uri.link:
+      if link.rel == 'http://schemas.google.com/g/2005#resumable-create-media':
+        return link.href
+    feed_uri = album_or_uri.GetFeedLink().href
+  return feed_uri.replace('/data/feed/',
+                          '/data/upload/resumable/media/create-session/feed/', 1)
+
+
+def _UploadedBytes(response):
+  """Returns how many bytes a 308 response says the server has."""
+  byte_range = response.getheader('Range') or response.getheader('range')
+  if not byte_range:
+    return 0
+  return int(byte_range.split('-')[-1]) + 1
+
+
+def _AddQueryParam(uri, name, value):
+  """Appends name=value to the query string of uri, starting one if needed."""
+  separator = '&' if '?' in uri else '?'
+  return '%s%s%s=%s' % (uri, separator, name, value)
+
+
+def BatchUri(feed_uri):
+  """Returns the batch uri of a feed, e.g. an album feed uri."""
+  return feed_uri.split('?', 1)[0].rstrip('/') + '/batch'
+
+
+def _BatchEntryFor(entry, operation, batch_id):
+  """Returns a copy of entry carrying a batch operation and id."""
+  batch_entry = copy.copy(entry)
+  batch_entry.extension_elements = list(entry.extension_elements) + [
+      gdata.BatchOperation(op_type=operation),
+      gdata.BatchId(text=batch_id)]
+  return batch_entry
+
+
 def GetSmallestThumbnail(media_thumbnail_list):
   """Helper function to get the smallest thumbnail of a list of
     gdata.media.Thumbnail.
@@ -60,7 +60,12 @@
 
 __author__ = 'api.jscudder (Jeffrey Scudder)'
 
+import hashlib
+import os
 import re
+import tempfile
+import threading
+import time
 import urllib
 import urlparse
 try:
@@ -183,6 +188,183 @@ class RanOutOfTries(Error):
   pass
 
 
+class ResponseCache(object):
+  """Keeps response bodies on disk with their ETag and Last-Modified.
+
+  GDataService sends these validators back so an unchanged resource is
+  answered with 304 Not Modified and its body read from here instead. One
+  file per response is kept under a directory, and the least recently used
+  ones are removed once they take more than max_bytes.
+  """
+
+  def __init__(self, path, max_bytes=64 << 20):
+    self.path = path
+    self.max_bytes = max_bytes
+    self._lock = threading.Lock()
+    self._sizes = None
+    self._total = 0
+
+  def _Scan(self):
+    """Lists the cached files, once. Callers must hold the lock."""
+    if self._sizes is not None:
+      return
+    if not os.path.isdir(self.path):
+      os.makedirs(self.path)
+    self._sizes = {}
+    for name in os.listdir(self.path):
+      filename = os.path.join(self.path, name)
+      try:
+        if not name.startswith('tmp'):
+          self._sizes[name] = os.path.getsize(filename)
+        elif os.path.getmtime(filename) < time.time() - 3600:
+          # Left over by a response that was not read to the end.
+          os.remove(filename)
+      except OSError:
+        pass
+    self._total = sum(self._sizes.values())
+
+  def Open(self, key):
+    """Returns (etag, last_modified, body stream) for key, or None."""
+    filename = os.path.join(self.path, key)
+    try:
+      stream = open(filename, 'rb')
+    except IOError:
+      return None
+    etag = stream.readline().rstrip('\n') or None
+    last_modified = stream.readline().rstrip('\n') or None
+    try:
+      os.utime(filename, None)
+    except OSError:
+      pass
+    return etag, last_modified, stream
+
+  def Writer(self, key, etag, last_modified):
+    """Returns a file to write the body of a response for key to.
+
+    The body replaces the cached one when the file is committed.
+    """
+    self._lock.acquire()
+    try:
+      self._Scan()
+    finally:
+      self._lock.release()
+    fd, temp = tempfile.mkstemp(prefix='tmp', dir=self.path)
+    writer = _CacheWriter(self, key, temp, os.fdopen(fd, 'wb'))
+    writer.write('%s\n%s\n' % (etag or '', last_modified or ''))
+    return writer
+
+  def _Commit(self, key, temp):
+    size = os.path.getsize(temp)
+    os.rename(temp, os.path.join(self.path, key))
+    self._lock.acquire()
+    try:
+      self._total += size - self._sizes.get(key, 0)
+      self._sizes[key] = size
+      if self._total > self.max_bytes:
+        self._Evict()
+    finally:
+      self._lock.release()
+
+  def _Evict(self):
+    """Removes least recently used files. Callers must hold the lock."""
+    def atime(name):
+      try:
+        return os.path.getmtime(os.path.join(self.path, name))
+      except OSError:
+        return 0
+    for name in sorted(self._sizes, key=atime):
+      if self._total <= self.max_bytes:
+        break
+      try:
+        os.remove(os.path.join(self.path, name))
+      except OSError:
+        pass
+      self._total -= self._sizes.pop(name)
+
+
+class _CacheWriter(object):
+  """A body being written to a ResponseCache."""
+
+  def __init__(self, cache, key, temp, stream):
+    self._cache = cache
+    self._key = key
+    self._temp = temp
+    self._stream = stream
+
+  def write(self, data):
+    self._stream.write(data)
+
+  def commit(self):
+    self._stream.close()
+    self._cache._Commit(self._key, self._temp)
+
+  def abort(self):
+    self._stream.close()
+    try:
+      os.remove(self._temp)
+    except OSError:
+      pass
+
+
+class CachingReader(object):
+  """Reads a response while copying its body to a cache writer.
+
+  The body is committed to the cache once it was read to the end.
+  """
+
+  def __init__(self, response, writer):
+    self._response = response
+    self._writer = writer
+
+  def read(self, size=-1):
+    try:
+      if size is None or size < 0:
+        data = self._response.read()
+      else:
+        data = self._response.read(size)
+    except:
+      self._Close(False)
+      raise
+    if self._writer is not None:
+      if data:
+        self._writer.write(data)
+      if not data or size is None or size < 0:
+        self._Close(True)
+    return data
+
+  def _Close(self, complete):
+    writer, self._writer = self._writer, None
+    if writer is not None:
+      if complete:
+        writer.commit()
+      else:
+        writer.abort()
+
+  def __getattr__(self, name):
+    return getattr(self._response, name)
+
+
+class _CachedResponse(object):
+  """A 200 response whose body comes from a ResponseCache."""
+  status = 200
+  reason = 'OK'
+
+  def __init__(self, body):
+    self._body = body
+
+  def read(self, size=-1):
+    if self._body is None:
+      return ''
+    data = self._body.read(size)
+    if not data or size is None or size < 0:
+      self._body.close()
+      self._body = None
+    return data
+
+  def getheader(self, name, default=None):
+    return default
+
+
 class GDataService(atom.service.AtomService):
   """Contains elements needed for GData login and CRUD request headers.
 
@@ -195,6 +377,8 @@ class GDataService(atom.service.AtomService):
   auth_token = None
   # The tokens dict is deprecated in favor of the token_store.
   tokens = None
+  # A ResponseCache to make GET requests conditional, or None.
+  response_cache = None
 
   def __init__(self, email=None, password=None, account_type='HOSTED_OR_GOOGLE',
                service=None, auth_service_url=None, source=None, server=None, 
@@ -1065,8 +1249,7 @@ class GDataService(atom.service.AtomService):
         else:
           uri += '?gsessionid=%s' % (self.__gsessionid,)
 
-    server_response = self.request('GET', uri, 
-        headers=extra_headers)
+    server_response = self.ConditionalGet(uri, extra_headers)
     result_body = server_response.read()
 
     if server_response.status == 200:
@@ -1107,6 +1290,49 @@ class GDataService(atom.service.AtomService):
       raise RequestError, {'status': server_response.status,
           'reason': server_response.reason, 'body': result_body}
 
+  def _CacheKey(self, uri):
+    # Responses differ between users, who may share a cache.
+    identity = self.email or str(self.current_token)
+    return hashlib.md5('%s\n%s' % (identity, uri)).hexdigest()
+
+  def ConditionalGet(self, uri, extra_headers=None):
+    """Sends a GET request, answered from response_cache when possible.
+
+    If response_cache is set and holds a previous response for uri, the
+    request is conditional on its ETag or Last-Modified, and a 304 Not
+    Modified answer is replaced with a 200 one reading the cached body. New
+    200 answers with validators are cached as their body is read.
+
+    Returns:
+      The server's response, whose body must be read to the end.
+    """
+    if self.response_cache is None:
+      return self.request('GET', uri, headers=extra_headers)
+    key = self._CacheKey(uri)
+    cached = self.response_cache.Open(key)
+    headers = dict(extra_headers or {})
+    if cached is not None:
+      etag, last_modified, body = cached
+      if etag:
+        headers['If-None-Match'] = etag
+      if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    response = None
+    try:
+      response = self.request('GET', uri, headers=headers)
+    finally:
+      if cached is not None and (response is None or response.status != 304):
+        body.close()
+    if response.status == 304 and cached is not None:
+      response.read()
+      return _CachedResponse(body)
+    etag = response.getheader('ETag')
+    last_modified = response.getheader('Last-Modified')
+    if response.status != 200 or not (etag or last_modified):
+      return response
+    return CachingReader(response, self.response_cache.Writer(
+        key, etag, last_modified))
+
   def GetMedia(self, uri, extra_headers=None):
     """Returns a MediaSource containing media and its metadata from the given
     URI string.
@@ -1,26 +1,101 @@
 #!/usr/bin/python
 
 import Queue
+import collections
+import ctypes
+import ctypes.util
+import errno
 import getpass
 import hashlib
+import httplib
 import itertools
+import json
+import multiprocessing
 import optparse
 import os
 import os.path
 import progressbar
 import re
+import select
+import socket
+import sqlite3
+import stat
+import struct
 import sys
 import threading
 import time
+import urllib
 
+import atom.http
+import atom.http_core
+import gdata
+import gdata.photos
 import gdata.photos.service
+import gdata.service
+
+scandir = None
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    pass
 
 g_options = None
 g_workers = None
+g_state = None
+g_hashers = None
+g_content = None
+g_requests = None
+g_uploads = None
+g_bandwidth = atom.http_core.TokenBucket()
+g_request_rate = atom.http_core.TokenBucket()
+g_transfers = atom.http_core.TransferStats()
+g_metrics = None
+g_display_lock = threading.Lock()
+
+# Large reads keep the per-file cost in hashlib, which releases the GIL, rather
+# than in the Python read loop.
+HASH_BLOCK_SIZE = 1 << 20
+
+# Times a photo is tried in one run before it is left for the next run.
+MAX_UPLOAD_TRIES = 3
+
+# Added to the size of each upload when comparing their speed, for the fixed
+# cost of a request.
+UPLOAD_OVERHEAD_BYTES = 256 << 10
+
+# AdaptiveLimit averages request timings per operation over the last few
+# requests, giving each new timing this weight, so single slow requests do not
+# count for much.
+RECENT_TIMING_WEIGHT = 0.05
+# The limit halves once that average reaches this many times the best one seen
+# for the operation.
+TIMING_SLOW_FACTOR = 2.0
+# Growth of the best average per request, to follow a network that got slower
+# for good.
+TIMING_DRIFT = 1.001
+
+# Albums waiting between sync pipeline stages. A few are enough to keep the
+# next stage busy while bounding how many scanned albums are held in memory.
+PIPELINE_QUEUE_SIZE = 8
+
+# Smaller requests gain too little from --gzip_requests to be worth the CPU.
+GZIP_REQUEST_MIN_BYTES = 4 << 10
+# How often --watch rewrites the --metrics_* files.
+METRICS_EXPORT_SECONDS = 60
+METRICS_PREFIX = 'google_picture_uploader_http'
+# How long --watch waits before trying a failed sync again.
+WATCH_RETRY_SECONDS = 300
 
 class ThreadPool:
-  def __init__(self, num_threads):
-    self.tasks = Queue.Queue(num_threads)
+  def __init__(self, num_threads, queue_size=None):
+    if queue_size == None:
+      queue_size = num_threads
+    self.num_threads = num_threads
+    self.tasks = Queue.Queue(queue_size)
+    self.done = threading.Condition()
     def run(index, tasks):
       while True:
         func, args, kargs = tasks.get()
@@ -32,6 +107,8 @@ class ThreadPool:
           print e
         finally:
           tasks.task_done()
+          with self.done:
+            self.done.notify_all()
     for i in range(num_threads):
       thread = threading.Thread(target=run, args=(i, self.tasks))
       thread.daemon = True
@@ -43,33 +120,824 @@ class ThreadPool:
   def Wait(self):
     self.tasks.join()
 
+  def WaitForIdleWorker(self):
+    """Blocks until a worker would be idle, no task waiting in the queue."""
+    with self.done:
+      while self.tasks.unfinished_tasks >= self.num_threads:
+        self.done.wait()
 
-def IsPhoto(file):
-  if not os.path.isfile(file):
-    return False
-  _, ext = os.path.splitext(file)
+
+class TaskGroup:
+  """Runs related tasks on a shared ThreadPool, a few at a time.
+
+  Tasks beyond max_in_flight wait in the group, so other groups can use the
+  remaining workers. on_done is called once Close() was called and all tasks
+  have run. The pool must have an unbounded queue since tasks are queued from
+  its own workers.
+  """
+  def __init__(self, pool, max_in_flight, on_done=None):
+    self.pool = pool
+    self.max_in_flight = max_in_flight
+    self.on_done = on_done
+    self.lock = threading.Lock()
+    self.waiting = collections.deque()
+    self.in_flight = 0
+    self.closed = False
+
+  def AddTask(self, func, *args, **kargs):
+    with self.lock:
+      self.waiting.append((func, args, kargs))
+    self._Dispatch()
+
+  def Close(self):
+    with self.lock:
+      self.closed = True
+    self._Dispatch()
+
+  def _Dispatch(self):
+    tasks = []
+    with self.lock:
+      while self.waiting and self.in_flight < self.max_in_flight:
+        tasks.append(self.waiting.popleft())
+        self.in_flight += 1
+      done = self.closed and not self.in_flight and not self.waiting
+      if done:
+        self.closed = False  # Calls on_done only once.
+    for task in tasks:
+      self.pool.AddTask(self._Run, *task)
+    if done and self.on_done:
+      self.on_done()
+
+  def _Run(self, func, args, kargs):
+    try:
+      func(*args, **kargs)
+    finally:
+      with self.lock:
+        self.in_flight -= 1
+      self._Dispatch()
+
+
+class AdaptiveLimit:
+  """Bounds the requests in flight, adapting the bound AIMD style.
+
+  Requests are timed per unit of cost, e.g. per byte for uploads or per entry
+  for feed pages, so the timing also tells when throughput stops growing with
+  concurrency. Timings are averaged per operation, told by the name of the
+  function run, over the last few requests, so the jitter of single requests
+  cancels out. While that average stays below twice the best one seen, each
+  request adds 1/limit to the limit, about one per round trip. Once it gets
+  slower, requests are queuing up somewhere and the limit is halved, as it is
+  by a request the server throttled or that failed to connect. Requests
+  already in flight when the limit was halved do not halve it again.
+  """
+  def __init__(self, initial, maximum):
+    self.limit = float(max(1, min(initial, maximum)))
+    self.maximum = max(1, maximum)
+    self.in_flight = 0
+    # [recent average, best average] of timings per unit of cost, by
+    # operation.
+    self.timings = {}
+    self.last_decrease = 0
+    self.cond = threading.Condition()
+
+  def Value(self):
+    return int(self.limit)
+
+  def Run(self, cost, func, *args, **kargs):
+    """Runs func, returning what it does. cost is a number, or a function
+    telling it from what func returned."""
+    with self.cond:
+      while self.in_flight >= int(self.limit):
+        self.cond.wait()
+      self.in_flight += 1
+    start = time.time()
+    congested = None
+    units = 1
+    try:
+      result = func(*args, **kargs)
+      congested = False
+      units = cost(result) if callable(cost) else cost
+      return result
+    except Exception as e:
+      if IsTransientError(e):
+        congested = True
+      raise
+    finally:
+      self._Done(func.__name__, start, time.time() - start, max(units, 1),
+                 congested)
+
+  def FeedRunner(self):
+    """Returns a run function for PhotosService.GetFeedEntries, running each
+    page request with Run and charging it per entry."""
+    page_cost = lambda page: len(page[1])
+    return lambda func, *args, **kargs: self.Run(page_cost, func, *args,
+                                                 **kargs)
+
+  def _Done(self, operation, start, elapsed, cost, congested):
+    with self.cond:
+      self.in_flight -= 1
+      if congested == False:
+        timing = elapsed / cost
+        averages = self.timings.setdefault(operation, [timing, timing])
+        averages[0] += (timing - averages[0]) * RECENT_TIMING_WEIGHT
+        averages[1] = min(averages[0], averages[1] * TIMING_DRIFT)
+        if averages[0] >= TIMING_SLOW_FACTOR * averages[1]:
+          congested = True
+        else:
+          self.limit = min(self.maximum, self.limit + 1 / self.limit)
+      if congested and start >= self.last_decrease:
+        self.limit = max(1.0, self.limit / 2)
+        self.last_decrease = time.time()
+        # Timings from before say nothing about the new limit.
+        for averages in self.timings.values():
+          averages[0] = averages[1]
+      self.cond.notify_all()
+
+
+def IsTransientError(e):
+  """Tells whether an error is worth retrying, and that requests should
+  slow down."""
+  if isinstance(e, (socket.error, httplib.HTTPException)):
+    return True
+  status = getattr(e, 'error_code', None)
+  if isinstance(e, gdata.service.RequestError) and e.args:
+    status = e.args[0].get('status')
+  return status in (429, 500, 502, 503, 504)
+
+
+def StartThread(func, *args):
+  thread = threading.Thread(target=func, args=args)
+  thread.daemon = True
+  thread.start()
+  return thread
+
+
+def ParseLimitSchedule(text):
+  """Parses 'HH:MM=KB/s[/requests/s],...' into a sorted list of
+  (minute of the day, bytes/s, requests/s), 0 meaning unlimited."""
+  schedule = []
+  for item in text.split(','):
+    match = re.match(r'^\s*(\d\d?):(\d\d)=(\d+(?:\.\d*)?)'
+                     r'(?:/(\d+(?:\.\d*)?))?\s*$', item)
+    if not match:
+      raise ValueError('Bad schedule entry: %r' % item)
+    hours, minutes = int(match.group(1)), int(match.group(2))
+    if hours > 23 or minutes > 59:
+      raise ValueError('Bad time of day: %r' % item)
+    schedule.append((hours * 60 + minutes, float(match.group(3)) * 1024,
+                     float(match.group(4) or 0)))
+  schedule.sort()
+  return schedule
+
+
+def SetLimits(bytes_per_second, requests_per_second):
+  g_bandwidth.set_rate(bytes_per_second)
+  g_request_rate.set_rate(requests_per_second)
+
+
+def FollowLimitSchedule(schedule):
+  """Applies the schedule entry in effect, checking every 30 seconds."""
+  while True:
+    now = time.localtime()
+    minute = now.tm_hour * 60 + now.tm_min
+    # Before the first entry of the day, the last one of the day before holds.
+    current = schedule[-1]
+    for entry in schedule:
+      if entry[0] <= minute:
+        current = entry
+    SetLimits(current[1], current[2])
+    time.sleep(30)
+
+
+def PrintTransferStats():
+  def mb(count):
+    return count / float(1 << 20)
+  print ('Sent %.1f MB (%.1f MB uncompressed), received %.1f MB (%.1f MB'
+         ' uncompressed).' % (mb(g_transfers.sent), mb(g_transfers.sent_raw),
+                              mb(g_transfers.received),
+                              mb(g_transfers.received_raw)))
+
+
+def ClassifyRequest(method, uri):
+  """Names the operation a request to Google does, to group its metrics."""
+  path, _, query = uri.partition('?')
+  method = method.upper()
+  if path.endswith('/ClientLogin'):
+    return 'login'
+  if method == 'DELETE':
+    return 'delete'
+  if path.endswith('/batch'):
+    return 'batch'
+  # Photos sent in one request or in chunks of a resumable session, and
+  # replaced through their edit-media link.
+  if '/data/upload/' in path or '/data/media/' in path:
+    return 'upload'
+  if method == 'POST':
+    if '/albumid/' in path:
+      return 'upload'
+    return 'create_album'
+  if method == 'PUT':
+    return 'update'
+  if method != 'GET':
+    return method.lower()
+  if '/data/entry/' in path:
+    return 'entry'
+  if 'kind=tag' in query:
+    return 'tag_feed'
+  if '/albumid/' in path:
+    return 'album_feed'
+  return 'album_list'
+
+
+def _WriteAtomically(path, data):
+  temp = '%s.tmp' % path
+  stream = open(temp, 'w')
+  try:
+    stream.write(data)
+  finally:
+    stream.close()
+  os.rename(temp, path)
+
+
+def ExportMetrics():
+  """Writes the request metrics to the --metrics_json and
+  --metrics_prometheus files."""
+  if g_options.metrics_json:
+    _WriteAtomically(g_options.metrics_json,
+                     json.dumps(g_metrics.summary(), indent=2,
+                                separators=(',', ': '), sort_keys=True) +
+                     '\n')
+  if g_options.metrics_prometheus:
+    _WriteAtomically(g_options.metrics_prometheus,
+                     g_metrics.prometheus(METRICS_PREFIX))
+
+
+def ExportMetricsPeriodically():
+  while True:
+    time.sleep(METRICS_EXPORT_SECONDS)
+    try:
+      ExportMetrics()
+    except (IOError, OSError) as e:
+      print 'Could not write metrics: %s' % e
+
+
+class HashPool:
+  """Computes photo checksums on a dedicated pool of threads."""
+  def __init__(self, num_threads):
+    self.workers = ThreadPool(num_threads)
+
+  def UpdateChecksums(self, photos, tags):
+    """Hashes all given photos and returns once every one is done."""
+    done = threading.Semaphore(0)
+    def run(photo):
+      try:
+        photo.UpdateChecksum(tags)
+      finally:
+        done.release()
+    for photo in photos:
+      self.workers.AddTask(run, photo)
+    for photo in photos:
+      done.acquire()
+
+
+def IsRotationalDisk(path):
+  """Tells whether path lives on a spinning disk, None when unknown."""
+  try:
+    dev = os.stat(path).st_dev
+  except OSError:
+    return None
+  base = '/sys/dev/block/%d:%d' % (os.major(dev), os.minor(dev))
+  # Partitions don't have a queue, their parent device does.
+  for queue in [os.path.join(base, 'queue'), os.path.join(base, '..', 'queue')]:
+    try:
+      with open(os.path.join(queue, 'rotational')) as stream:
+        return stream.read().strip() == '1'
+    except IOError:
+      pass
+  return None
+
+
+def GuessHashParallelism(path):
+  cpus = multiprocessing.cpu_count()
+  rotational = IsRotationalDisk(path)
+  if rotational:
+    # Concurrent reads on a spinning disk only add seeks.
+    return 2
+  if rotational == None:
+    # Likely a network mount, where latency rather than CPU dominates.
+    return max(4, cpus)
+  return cpus
+
+
+def HashFile(path, *digests):
+  """Feeds the contents of path to all digests, reading it once."""
+  stream = open(path, 'rb')
+  try:
+    while True:
+      data = stream.read(HASH_BLOCK_SIZE)
+      if not data:
+        break
+      for digest in digests:
+        digest.update(data)
+  finally:
+    stream.close()
+
+
+def IsPhotoName(filename):
+  _, ext = os.path.splitext(filename)
   return ext and ext.lower() in ['.jpg', '.png', '.gif']
 
 
+# What is known about a photo file after walking the tree.
+PhotoFile = collections.namedtuple('PhotoFile', 'name size mtime inode')
+
+
+def _ListDir(path):
+  """Yields (name, is_dir, get_stat) for each entry under path.
+
+  Symbolic links to folders are not reported as folders, like os.walk. Only
+  get_stat() may cost an extra system call.
+  """
+  if scandir:
+    for entry in scandir(path):
+      yield entry.name, entry.is_dir(follow_symlinks=False), entry.stat
+    return
+  for name in os.listdir(path):
+    try:
+      st = os.lstat(os.path.join(path, name))
+      if stat.S_ISLNK(st.st_mode):
+        is_dir = False
+        st = os.stat(os.path.join(path, name))
+      else:
+        is_dir = stat.S_ISDIR(st.st_mode)
+    except OSError:
+      continue
+    yield name, is_dir, lambda st=st: st
+
+
+def ScanFolder(path):
+  """Returns ([PhotoFile], [sub folder]) of a single folder."""
+  files = []
+  folders = []
+  try:
+    entries = list(_ListDir(path))
+  except OSError:
+    return files, folders
+  for name, is_dir, get_stat in entries:
+    if is_dir:
+      folders.append(os.path.join(path, name))
+    elif IsPhotoName(name):
+      try:
+        st = get_stat()
+      except OSError:
+        continue
+      if stat.S_ISREG(st.st_mode):
+        files.append(PhotoFile(name, st.st_size, st.st_mtime, st.st_ino))
+  return files, folders
+
+
+def ScanPhotoTree(root):
+  """Walks root once, returning {folder: [PhotoFile]} for folders with photos.
+
+  Only files named like photos are stat'ed, at most once each.
+  """
+  index = {}
+  pending = [root]
+  while pending:
+    path = pending.pop()
+    files, folders = ScanFolder(path)
+    pending.extend(folders)
+    if files:
+      index[path] = files
+  return index
+
+
+class FolderWatcher:
+  """Tells which folders under root had photos changed, with Linux inotify.
+
+  Every folder is watched, including the ones created later. Changes are
+  reported once they stop coming for a while, so copying many photos makes
+  a single sync. If root itself is deleted, moved or unmounted, nothing is
+  watched until WaitForRoot. IOError is raised where inotify is not
+  available.
+  """
+  # From <sys/inotify.h>.
+  IN_ATTRIB = 0x4
+  IN_CLOSE_WRITE = 0x8
+  IN_MOVED_FROM = 0x40
+  IN_MOVED_TO = 0x80
+  IN_CREATE = 0x100
+  IN_DELETE = 0x200
+  IN_DELETE_SELF = 0x400
+  IN_MOVE_SELF = 0x800
+  IN_UNMOUNT = 0x2000
+  IN_Q_OVERFLOW = 0x4000
+  IN_IGNORED = 0x8000
+  IN_ONLYDIR = 0x1000000
+  IN_ISDIR = 0x40000000
+  EVENT = struct.Struct('iIII')
+  MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+          IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+  def __init__(self, root):
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+      raise IOError(errno.ENOSYS, 'C library not found')
+    self.libc = ctypes.CDLL(libc_name, use_errno=True)
+    if not hasattr(self.libc, 'inotify_init'):
+      raise IOError(errno.ENOSYS, 'inotify is not available')
+    self.fd = self.libc.inotify_init()
+    if self.fd < 0:
+      raise IOError(ctypes.get_errno(), 'inotify_init failed')
+    self.root = root
+    self.folders = {}
+    # Set when events were lost and only a full sync can tell what changed.
+    self.overflowed = False
+    # Set when root was deleted or moved.
+    self.root_gone = False
+    self._Watch(root)
+
+  def _Watch(self, root):
+    """Watches root and the folders under it, returning the ones with photos
+    as they may be new."""
+    with_photos = []
+    pending = [root]
+    while pending:
+      path = pending.pop()
+      wd = self.libc.inotify_add_watch(self.fd, path, self.MASK)
+      if wd < 0:
+        if ctypes.get_errno() == errno.ENOSPC:
+          print 'Too many folders to watch, raise fs.inotify.max_user_watches.'
+        continue
+      self.folders[wd] = path
+      files, folders = ScanFolder(path)
+      pending.extend(folders)
+      if files:
+        with_photos.append(path)
+    return with_photos
+
+  def _Unwatch(self, root):
+    """Stops watching root and the folders under it, e.g. once moved,
+    returning them."""
+    unwatched = []
+    for wd, path in self.folders.items():
+      if path == root or path.startswith(root + os.sep):
+        self.libc.inotify_rm_watch(self.fd, wd)
+        del self.folders[wd]
+        unwatched.append(path)
+    return unwatched
+
+  def WaitForRoot(self, poll):
+    """Waits for root to be back after it was deleted or moved, checking
+    every poll seconds, and watches it again."""
+    while not os.path.isdir(self.root):
+      time.sleep(poll)
+    self._Watch(self.root)
+    self.root_gone = False
+
+  def _ReadEvents(self):
+    """Returns the folders changed by the pending events."""
+    changed = set()
+    data = os.read(self.fd, 1 << 16)
+    offset = 0
+    while offset < len(data):
+      wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+      offset += self.EVENT.size
+      name = data[offset:offset + length].rstrip('\0')
+      offset += length
+      if mask & self.IN_Q_OVERFLOW:
+        self.overflowed = True
+        continue
+      folder = self.folders.get(wd)
+      if folder == None:
+        continue
+      if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF | self.IN_UNMOUNT):
+        # Other folders are handled by the events of their parent.
+        if folder == self.root:
+          # Watches of a moved root follow it, away from the paths known.
+          for wd in self.folders.keys():
+            self.libc.inotify_rm_watch(self.fd, wd)
+          self.folders = {}
+          self.root_gone = True
+      elif mask & self.IN_IGNORED:
+        self.folders.pop(wd, None)
+      elif mask & self.IN_ISDIR:
+        if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+          changed.update(self._Watch(os.path.join(folder, name)))
+        elif mask & self.IN_MOVED_FROM:
+          # Folders moved within root are watched again under their new name,
+          # and their photos are gone from the old one.
+          changed.update(self._Unwatch(os.path.join(folder, name)))
+      elif name and IsPhotoName(name):
+        changed.add(folder)
+    return changed
+
+  def WaitForChanges(self, delay, timeout):
+    """Waits up to timeout seconds for changes, then until none came for
+    delay seconds. Returns the changed folders."""
+    changed = set()
+    deadline = time.time() + timeout
+    while not changed and not self.overflowed and not self.root_gone:
+      wait = deadline - time.time()
+      if wait <= 0:
+        break
+      if select.select([self.fd], [], [], wait)[0]:
+        changed.update(self._ReadEvents())
+    # Bursts are bounded, so a folder always changing still gets synced.
+    settle = time.time() + 10 * delay
+    while changed and time.time() < settle:
+      if not select.select([self.fd], [], [], delay)[0]:
+        break
+      changed.update(self._ReadEvents())
+    return changed
+
+
 def TryStripPrefix(prefix, text):
   if text.startswith(prefix):
     return text[len(prefix):]
   return text
 
 
+class SyncState:
+  """Remembers what was synced on previous runs, keyed by local path.
+
+  Photos are stored with the file attributes and album tags used to compute
+  their checksum so unchanged files are not hashed again, and with the remote
+  photo holding their contents so moved files are found on Google. Albums are
+  stored with a fingerprint of their local contents, the version of their
+  remote entry and the number of photos it holds so albums unchanged on both
+  sides skip all remote queries. The remote album entries are kept too, so
+  only albums changed since are listed next time.
+  Resumable uploads in progress are stored so the next run continues them.
+  """
+  def __init__(self, path):
+    self.lock = threading.Lock()
+    self.db = None
+    if not path:
+      return
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    self.db = sqlite3.connect(path, check_same_thread=False)
+    self.db.text_factory = str
+    self.db.execute('CREATE TABLE IF NOT EXISTS photos ('
+                    ' path TEXT PRIMARY KEY, size INTEGER, mtime REAL,'
+                    ' inode INTEGER, checksum_tag TEXT, photo_id TEXT,'
+                    ' album_id TEXT, content_md5 TEXT, album_tags TEXT)')
+    for column in ('content_md5', 'album_tags'):
+      try:
+        self.db.execute('ALTER TABLE photos ADD COLUMN %s TEXT' % column)
+      except sqlite3.OperationalError:
+        pass  # Already there.
+    self.db.execute('CREATE INDEX IF NOT EXISTS photos_photo_id'
+                    ' ON photos (photo_id)')
+    self.db.execute('CREATE TABLE IF NOT EXISTS albums ('
+                    ' key TEXT PRIMARY KEY, fingerprint TEXT, album_id TEXT,'
+                    ' version TEXT, num_remote_photos INTEGER)')
+    for column in ('version TEXT', 'num_remote_photos INTEGER'):
+      try:
+        self.db.execute('ALTER TABLE albums ADD COLUMN %s' % column)
+      except sqlite3.OperationalError:
+        pass  # Already there.
+    self.db.execute('CREATE TABLE IF NOT EXISTS remote_albums ('
+                    ' album_id TEXT PRIMARY KEY, entry TEXT)')
+    self.db.execute('CREATE TABLE IF NOT EXISTS settings ('
+                    ' name TEXT PRIMARY KEY, value TEXT)')
+    self.db.execute('CREATE TABLE IF NOT EXISTS uploads ('
+                    ' path TEXT PRIMARY KEY, checksum_tag TEXT,'
+                    ' album_id TEXT, session_uri TEXT, offset INTEGER)')
+    self.db.commit()
+
+  def _Query(self, sql, args):
+    with self.lock:
+      return self.db.execute(sql, args).fetchone()
+
+  def _Update(self, sql, args):
+    with self.lock:
+      self.db.execute(sql, args)
+
+  def GetChecksum(self, path, file, album_tags=None):
+    """Returns (checksum_tag, content_md5) if file did not change.
+
+    The checksum tag also covers the album tags, which change with --root:
+    unless album_tags is None, only a tag computed with them is returned.
+    """
+    if self.db == None:
+      return None
+    row = self._Query('SELECT size, mtime, inode, checksum_tag, content_md5,'
+                      ' album_tags FROM photos WHERE path = ?', (path,))
+    # Rows from before content hashes were kept are hashed again.
+    if (row and tuple(row[:3]) == (file.size, file.mtime, file.inode) and
+        row[4] and (album_tags == None or row[5] == album_tags)):
+      return tuple(row[3:5])
+    return None
+
+  def PutChecksum(self, path, file, album_tags, checksum_tag, content_md5):
+    if self.db == None:
+      return
+    self._Update('INSERT OR IGNORE INTO photos (path) VALUES (?)', (path,))
+    self._Update('UPDATE photos SET size = ?, mtime = ?, inode = ?,'
+                 ' album_tags = ?, checksum_tag = ?, content_md5 = ?'
+                 ' WHERE path = ?',
+                 (file.size, file.mtime, file.inode, album_tags, checksum_tag,
+                  content_md5, path))
+
+  def PutRemotePhoto(self, path, photo_id, album_id):
+    if self.db == None:
+      return
+    # A remote photo holds a single local file, the one it last moved to.
+    self._Update('UPDATE photos SET photo_id = NULL, album_id = NULL'
+                 ' WHERE photo_id = ? AND path != ?', (photo_id, path))
+    self._Update('UPDATE photos SET photo_id = ?, album_id = ?'
+                 ' WHERE path = ?', (photo_id, album_id, path))
+
+  def GetRemoteCopies(self):
+    """Returns a RemoteCopy for each local file known to be on Google."""
+    if self.db == None:
+      return []
+    with self.lock:
+      return [RemoteCopy(*row) for row in self.db.execute(
+          'SELECT content_md5, photo_id, album_id, path, checksum_tag'
+          ' FROM photos WHERE photo_id IS NOT NULL'
+          ' AND content_md5 IS NOT NULL')]
+
+  def GetAlbum(self, key):
+    """Returns (fingerprint, album_id, version, num_remote_photos) of the
+    last sync."""
+    if self.db == None:
+      return (None, None, None, None)
+    row = self._Query('SELECT fingerprint, album_id, version,'
+                      ' num_remote_photos FROM albums WHERE key = ?', (key,))
+    return tuple(row) if row else (None, None, None, None)
+
+  def PutAlbum(self, key, fingerprint, album_id, version, num_remote_photos):
+    if self.db == None:
+      return
+    self._Update('INSERT OR REPLACE INTO albums (key, fingerprint, album_id,'
+                 ' version, num_remote_photos) VALUES (?, ?, ?, ?, ?)',
+                 (key, fingerprint, album_id, version, num_remote_photos))
+
+  def GetRemoteAlbums(self):
+    """Returns the album entries listed by previous runs."""
+    if self.db == None:
+      return []
+    with self.lock:
+      return [gdata.photos.AlbumEntryFromString(row[0]) for row in
+              self.db.execute('SELECT entry FROM remote_albums')]
+
+  def PutRemoteAlbum(self, entry):
+    if self.db == None:
+      return
+    self._Update('INSERT OR REPLACE INTO remote_albums (album_id, entry)'
+                 ' VALUES (?, ?)', (entry.gphoto_id.text, entry.ToString()))
+
+  def DeleteRemoteAlbums(self, album_ids=None):
+    """Forgets the given album entries, or all of them."""
+    if self.db == None:
+      return
+    if album_ids == None:
+      self._Update('DELETE FROM remote_albums', ())
+    for album_id in album_ids or []:
+      self._Update('DELETE FROM remote_albums WHERE album_id = ?',
+                   (album_id,))
+
+  def GetSetting(self, name):
+    if self.db == None:
+      return None
+    row = self._Query('SELECT value FROM settings WHERE name = ?', (name,))
+    return row[0] if row else None
+
+  def PutSetting(self, name, value):
+    if self.db == None:
+      return
+    self._Update('INSERT OR REPLACE INTO settings (name, value)'
+                 ' VALUES (?, ?)', (name, value))
+
+  def GetUpload(self, path, checksum_tag, album_id):
+    """Returns the session uri of an interrupted upload of this content."""
+    if self.db == None:
+      return None
+    row = self._Query('SELECT checksum_tag, album_id, session_uri FROM uploads'
+                      ' WHERE path = ?', (path,))
+    if row and tuple(row[:2]) == (checksum_tag, album_id):
+      return row[2]
+    return None
+
+  def PutUpload(self, path, checksum_tag, album_id, session_uri, offset):
+    if self.db == None:
+      return
+    self._Update('INSERT OR REPLACE INTO uploads (path, checksum_tag,'
+                 ' album_id, session_uri, offset) VALUES (?, ?, ?, ?, ?)',
+                 (path, checksum_tag, album_id, session_uri, offset))
+    self.Commit()
+
+  def DeleteUpload(self, path):
+    if self.db == None:
+      return
+    self._Update('DELETE FROM uploads WHERE path = ?', (path,))
+
+  def Commit(self):
+    if self.db == None:
+      return
+    with self.lock:
+      self.db.commit()
+
+  def Close(self):
+    if self.db == None:
+      return
+    self.Commit()
+    self.db.close()
+    self.db = None
+
+
+# A remote photo, with the local file it was last synced from.
+RemoteCopy = collections.namedtuple(
+    'RemoteCopy', 'content_md5 photo_id album_id path checksum_tag')
+
+
+class ContentIndex:
+  """Finds remote photos by the MD5 of their bytes alone.
+
+  Checksum tags also cover the photo name and album, so they change when a
+  folder is renamed. This index tells instead which remote photo already
+  holds the bytes of a local file, whatever album it is in. Claims make sure
+  a remote photo is moved, replaced or deleted for a single local photo,
+  named by its (album key, photo key).
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.copies = {}
+    self.contents = {}
+    self.claims = {}
+
+  def Load(self, state):
+    for copy in state.GetRemoteCopies():
+      self.Add(copy)
+
+  def Add(self, copy):
+    with self.lock:
+      old = self.copies.get(copy.content_md5)
+      if old != None and self.contents.get(old.photo_id) == copy.content_md5:
+        del self.contents[old.photo_id]
+      self.copies[copy.content_md5] = copy
+      self.contents[copy.photo_id] = copy.content_md5
+
+  def Find(self, content_md5):
+    with self.lock:
+      return self.copies.get(content_md5)
+
+  def ContentOf(self, photo_id):
+    with self.lock:
+      return self.contents.get(photo_id)
+
+  def Claim(self, photo_id, owner):
+    """Returns whether owner may move, replace or delete photo_id."""
+    with self.lock:
+      return self.claims.setdefault(photo_id, owner) == owner
+
+  def ClearClaims(self):
+    """Forgets claims, e.g. of a previous sync whose photos moved since."""
+    with self.lock:
+      self.claims = {}
+
+
+def _IsGone(path):
+  """Tells whether the photo file at path was removed or renamed."""
+  return not IsPhotoName(os.path.basename(path)) or not os.path.isfile(path)
+
+
+def _HasContent(path, content_md5):
+  """Tells whether the file at path still has the given bytes."""
+  try:
+    st = os.stat(path)
+  except OSError:
+    return False
+  if g_state.db == None:
+    return True  # Can't tell, don't take its remote photo away.
+  checksums = g_state.GetChecksum(path, PhotoFile(
+      os.path.basename(path), st.st_size, st.st_mtime, st.st_ino))
+  return checksums != None and checksums[1] == content_md5
+
+
 class Photo:
+  DELETED = 'delete'
+  DUPLICATE = 'duplicate'
   ERROR = 'error'
+  MOVED = 'move'
   NONE = 'none'
   SKIPPED = 'skip'
   UPLOADED = 'upload'
-  ALL_STATUS = [ERROR, NONE, SKIPPED, UPLOADED]
+  ALL_STATUS = [DELETED, DUPLICATE, ERROR, MOVED, NONE, SKIPPED, UPLOADED]
 
   def __init__(self, key):
     self.key = key
     self.path = None
+    self.file = None
     self.remote = None
     self.checksum_tag = None
+    self.content_md5 = None
     self.status = Photo.NONE
+    self.tries = 0
 
   def __repr__(self):
     return 'Photo("%s", %s, %s)' % (
@@ -78,17 +946,20 @@ class Photo:
         ('"%s"' % self.remote.title.text if self.remote else 'null'))
 
   def UpdateChecksum(self, tags):
+    album_tags = tags.__str__()
+    checksums = g_state.GetChecksum(self.path, self.file, album_tags)
+    if checksums:
+      self.checksum_tag, self.content_md5 = checksums
+      return
     md5 = hashlib.md5()
     md5.update(self.key)
-    md5.update(tags.__str__())
-    stream = open(self.path, 'rb')
-    while True:
-      data = stream.read(128)
-      if not data:
-        break
-      md5.update(data)
-    stream.close()
+    md5.update(album_tags)
+    content_md5 = hashlib.md5()
+    HashFile(self.path, md5, content_md5)
     self.checksum_tag = 'md5_%s' % md5.hexdigest()
+    self.content_md5 = content_md5.hexdigest()
+    g_state.PutChecksum(self.path, self.file, album_tags, self.checksum_tag,
+                        self.content_md5)
 
 
 class Counter:
@@ -104,15 +975,117 @@ class Counter:
     return self._value
 
 
+class ProgressLine:
+  """Shares the terminal line between the progress bars of albums syncing at
+  the same time.
+
+  Only the bar started first is drawn. The others are drawn once they
+  finish, above it, or once they get the line. Callers hold g_display_lock.
+  """
+  def __init__(self, fd=sys.stderr):
+    self.fd = fd
+    self.outputs = []
+
+  def Output(self):
+    """Returns the file a new progress bar should write to."""
+    output = _ProgressLineOutput(self)
+    self.outputs.append(output)
+    return output
+
+  def _Write(self, output, text):
+    if text != '\n':
+      output.line = text.rstrip('\r')
+      if output is self.outputs[0]:
+        self.fd.write(text)
+      return
+    # The bar finished.
+    drawn = self.outputs[0]
+    self.outputs.remove(output)
+    if output is not drawn:
+      self.fd.write('%s\n%s\r' % (output.line, drawn.line))
+      return
+    self.fd.write('\n')
+    if self.outputs:
+      self.fd.write(self.outputs[0].line + '\r')
+
+
+class _ProgressLineOutput:
+  def __init__(self, progress_line):
+    self.progress_line = progress_line
+    self.line = ''
+
+  def write(self, text):
+    self.progress_line._Write(self, text)
+
+  def fileno(self):
+    # Lets progress bars tell the terminal width.
+    return self.progress_line.fd.fileno()
+
+
+def _GetKeywords(entry):
+  """Returns the media:keywords of a photo entry as a frozenset."""
+  if (entry.media == None or entry.media.keywords == None or
+      not entry.media.keywords.text):
+    return frozenset()
+  return frozenset(keyword.strip()
+                   for keyword in entry.media.keywords.text.split(','))
+
+
+def _GetVersion(entry):
+  """Returns what changes whenever a remote entry changes."""
+  etag = entry.extension_attributes.get('{%s}etag' % gdata.GDATA_NAMESPACE)
+  if etag:
+    return etag
+  if entry.updated != None:
+    return entry.updated.text
+  return None
+
+
+def _HasChecksum(entry, checksum_tag):
+  """Tells whether a photo entry was uploaded with checksum_tag."""
+  if entry.checksum != None and entry.checksum.text:
+    return entry.checksum.text == checksum_tag
+  return checksum_tag in _GetKeywords(entry)
+
+
+def _DeleteEntries(service, feed_uri, entries):
+  """Deletes entries of a feed in batches, returning which were deleted.
+
+  Entries a batch did not delete are retried one by one, which also covers
+  servers without batch support.
+  """
+  try:
+    statuses = g_requests.Run(
+        len(entries), service.DeleteBatch, entries,
+        gdata.photos.service.BatchUri(feed_uri))
+  except (gdata.photos.service.GooglePhotosException, socket.error,
+          httplib.HTTPException):
+    statuses = [None] * len(entries)
+  deleted = []
+  for entry, status in zip(entries, statuses):
+    if status != None and status.code and status.code.startswith('2'):
+      deleted.append(True)
+      continue
+    try:
+      g_requests.Run(1, service.Delete, entry)
+      deleted.append(True)
+    except (gdata.photos.service.GooglePhotosException, socket.error,
+            httplib.HTTPException):
+      deleted.append(False)
+  return deleted
+
+
 class Album:
   def __init__(self, service, key):
     self.service = service
     self.key = key
     self.path = None
+    self.files = []
     self.num_local_photos = 0
     self.remote = None
     self.photos = None
-    self.photo_md5s = None
+    self.has_remote_photos = False
+    self.photo_keywords = {}
     self.needs_update = True
     self.album_tags = frozenset(re.split('[\W\\/]+', key))
 
@@ -122,99 +1095,291 @@ class Album:
         ('"%s"' % self.path) if self.path else 'null',
         ('"%s"' % self.remote.title.text if self.remote else 'null'))
 
-  def _ScanPhotosFromDisk(self):
+  def _ListPhotosFromDisk(self):
     if self.photos == None:
       self.photos = {}
       if self.path == None:
         return
-      for filename in os.listdir(self.path):
-        filepath = os.path.join(self.path, filename)
-        if IsPhoto(filepath):
-          key, ext = os.path.splitext(filename)
-          if key not in self.photos:
-            self.photos[key] = Photo(key)
-          photo = self.photos[key]
-          photo.path = filepath
-          photo.UpdateChecksum(self.album_tags)
-
-  def _GetPhotoMd5s(self):
-    if self.photo_md5s == None:
-      tags = set()
-      for entry in self.service.GetFeed(self.remote.GetTagsUri()).entry:
-        if entry.title and entry.title.text.startswith('md5_'):
-          tags.add(entry.title.text)
-      self.photo_md5s = frozenset(tags)
-    return self.photo_md5s
+      for file in self.files:
+        key, ext = os.path.splitext(file.name)
+        if key not in self.photos:
+          self.photos[key] = Photo(key)
+        photo = self.photos[key]
+        photo.path = os.path.join(self.path, file.name)
+        photo.file = file
 
-  def CheckNeedUpdate(self):
+  def _ScanPhotosFromDisk(self):
+    self._ListPhotosFromDisk()
+    g_hashers.UpdateChecksums(
+        [photo for photo in self.photos.itervalues()
+         if photo.path and not photo.checksum_tag],
+        self.album_tags)
+
+  def _GetFingerprint(self):
+    """Summarizes local contents of the album without reading any photo."""
+    self._ListPhotosFromDisk()
+    md5 = hashlib.md5()
+    for key in sorted(self.photos.keys()):
+      photo = self.photos[key]
+      if photo.path:
+        md5.update('%s:%d:%r:%d\n' % (
+            photo.path, photo.file.size, photo.file.mtime, photo.file.inode))
+    return md5.hexdigest()
+
+  def _IsUnchangedSinceLastSync(self):
+    fingerprint, album_id, version, num_remote_photos = g_state.GetAlbum(
+        self.key)
+    # Duplicates are not uploaded and photos only on Google may be kept, so
+    # the album may hold fewer or more photos than the folder.
+    if num_remote_photos == None:
+      num_remote_photos = self.num_local_photos
+    return (fingerprint != None and
+            fingerprint == self._GetFingerprint() and
+            album_id == self.remote.gphoto_id.text and
+            version == _GetVersion(self.remote) and
+            num_remote_photos == int(self.remote.numphotos))
+
+  def _SaveSyncState(self):
     if self.remote == None:
-      self.needs_update = True
       return
+    for photo in self.photos.itervalues():
+      if photo.status == Photo.ERROR:
+        return
+    num_remote_photos = len([photo for photo in self.photos.itervalues()
+                             if photo.remote != None])
+    g_state.PutAlbum(self.key, self._GetFingerprint(),
+                     self.remote.gphoto_id.text, _GetVersion(self.remote),
+                     num_remote_photos)
+    g_state.Commit()
+
+  def CheckLocalChanges(self):
+    """Decides what can be told without photo lists from Google.
+
+    Hashes local photos when needed. Returns whether CheckRemoteChanges must
+    be called to tell if the album needs update.
+    """
+    if self.remote == None:
+      self.needs_update = True
+      return False
     if g_options.quick_check:
       self.needs_update = self.num_local_photos != int(self.remote.numphotos)
-      return
+      return False
+    if self._IsUnchangedSinceLastSync():
+      self.needs_update = False
+      return False
     self._ScanPhotosFromDisk()
-    md5s = self._GetPhotoMd5s()
-    count = 0
+    return True
+
+  def CheckNeedUpdate(self):
+    if self.CheckLocalChanges():
+      self.CheckRemoteChanges()
+
+  def CheckRemoteChanges(self):
+    self._GetPhotosFromGoogle()
     for key, photo in self.photos.iteritems():
-      if photo.path:
-        count += 1
-        if photo.checksum_tag not in md5s:
-          self.needs_update = True
-          return
-    self.needs_update = count != len(md5s)
+      if photo.path == None or not self._IsUpToDate(photo):
+        self.needs_update = True
+        return
+    self.needs_update = False
+    self._SaveSyncState()
+    # Nothing else will look at this album, release its photo entries.
+    self.photos = None
+
+  def _IsUpToDate(self, photo):
+    if photo.remote == None:
+      return False
+    if photo.remote.checksum != None and photo.remote.checksum.text:
+      return photo.remote.checksum.text == photo.checksum_tag
+    # Uploaded before checksums were set, only the keywords can tell.
+    return photo.checksum_tag in self.photo_keywords.get(photo.key, ())
 
   def _GetPhotosFromGoogle(self):
+    if self.has_remote_photos:
+      return
+    try:
+      self._ReadPhotosFromGoogle()
+    except gdata.photos.service.GooglePhotosException as e:
+      if e.error_code not in (404, 410):
+        raise
+      # Deleted on Google since the album list was cached, see
+      # GooglePictureUploader._ListAlbumsFromGoogle. SyncPhotos creates it
+      # again.
+      g_state.DeleteRemoteAlbums([self.remote.gphoto_id.text])
+      self.remote = None
+      self.photos = dict((key, photo) for key, photo in self.photos.iteritems()
+                         if photo.path != None)
+      for photo in self.photos.itervalues():
+        photo.remote = None
+      self.photo_keywords = {}
+      self.needs_update = True
+    self.has_remote_photos = True
+
+  def _ReadPhotosFromGoogle(self):
     url = '/data/feed/api/user/default/albumid/%s?kind=photo' % (
         self.remote.gphoto_id.text)
-    for photo in self.service.GetFeed(url).entry:
+    # Each page, prefetched ones included, is a request within g_requests.
+    for photo in self.service.GetFeedEntries(url,
+                                             run=g_requests.FeedRunner()):
       key = photo.title.text
       if key not in self.photos:
         self.photos[key] = Photo(key)
       self.photos[key].remote = photo
+      keywords = _GetKeywords(photo)
+      if keywords:
+        self.photo_keywords[key] = keywords
 
-  def _DeletePhoto(self, key):
+  def _DeletePhotoBatch(self, url, photos, callback):
+    deleted = _DeleteEntries(self.service, url,
+                             [photo.remote for photo in photos])
+    for photo, ok in zip(photos, deleted):
+      if ok:
+        del self.photos[photo.key]
+        photo.status = Photo.DELETED
+      else:
+        photo.status = Photo.ERROR
+      callback(photo)
+
+  def _DeletePhotos(self, tasks, url, photos, callback):
+    deletable = []
+    for photo in photos:
+      if (photo.remote.GetEditLink() and
+          g_content.Claim(photo.remote.gphoto_id.text, (self.key, photo.key))):
+        deletable.append(photo)
+      else:
+        del self.photos[photo.key]
+        photo.status = Photo.SKIPPED
+        callback(photo)
+    batch_size = self.service.batch_size
+    for first in range(0, len(deletable), batch_size):
+      tasks.AddTask(self._DeletePhotoBatch, url,
+                    deletable[first:first + batch_size], callback)
+
+  def _SetStatus(self, photo, status):
+    photo.status = status
+    if photo.remote != None and photo.remote.gphoto_id != None:
+      g_state.PutRemotePhoto(photo.path, photo.remote.gphoto_id.text,
+                             self.remote.gphoto_id.text)
+      g_content.Add(RemoteCopy(photo.content_md5, photo.remote.gphoto_id.text,
+                               self.remote.gphoto_id.text, photo.path,
+                               photo.checksum_tag))
+
+  def _ReuseRemoteCopy(self, photo, tags):
+    """Avoids uploading bytes Google already has.
+
+    A remote photo whose local file is gone, e.g. after a folder rename, is
+    moved to this album. A local file whose bytes are also in another local
+    file already on Google is counted as a duplicate, unless
+    --upload_duplicates. Returns whether the photo was taken care of.
+    """
+    copy = g_content.Find(photo.content_md5)
+    if copy == None or copy.path == photo.path:
+      return False
+    if not _IsGone(copy.path):
+      # A file edited in place still owns its remote photo, which its album
+      # replaces.
+      if g_options.upload_duplicates or not _HasContent(copy.path,
+                                                        copy.content_md5):
+        return False
+      photo.status = Photo.DUPLICATE
+      return True
+    if not g_content.Claim(copy.photo_id, (self.key, photo.key)):
+      return False
     try:
-      photo = self.photos[key]
-      if photo.path == None:
-        del self.photos[key]
-        if photo.remote.GetEditLink():
-          self.service.Delete(photo.remote)
-    except:
-      pass
+      entry = g_requests.Run(1, self.service.GetEntry,
+          '/data/entry/api/user/default/albumid/%s/photoid/%s' % (
+              copy.album_id, copy.photo_id))
+    except gdata.photos.service.GooglePhotosException as e:
+      if IsTransientError(e):
+        raise
+      return False  # Deleted meanwhile.
+    if not _HasChecksum(entry, copy.checksum_tag) or not entry.GetEditLink():
+      return False
+    photo.remote = g_requests.Run(1, self.service.MovePhoto, entry,
+        self.remote.gphoto_id.text, photo.key, tags, photo.checksum_tag)
+    self._SetStatus(photo, Photo.MOVED)
+    return True
 
-  def _DeletePhotos(self):
-    for key in list(self.photos.keys()):
-      g_workers.AddTask(self._DeletePhoto, key)
-    g_workers.Wait()
+  def _InsertPhoto(self, url, key, photo, tags):
+    cost = photo.file.size + UPLOAD_OVERHEAD_BYTES
+    if photo.file.size < g_options.resumable_upload_mb * (1 << 20):
+      return g_uploads.Run(cost, self.service.InsertPhotoSimple,
+          url, key, '', photo.path, keywords=tags,
+          checksum=photo.checksum_tag)
+    album_id = self.remote.gphoto_id.text
+    def checkpoint(session_uri, offset):
+      g_state.PutUpload(photo.path, photo.checksum_tag, album_id,
+                        session_uri, offset)
+    try:
+      entry = g_uploads.Run(cost, self.service.InsertPhotoSimple,
+          url, key, '', photo.path, keywords=tags,
+          checksum=photo.checksum_tag, resumable=True,
+          session_uri=g_state.GetUpload(photo.path, photo.checksum_tag,
+                                        album_id),
+          on_progress=checkpoint)
+    except gdata.photos.service.GooglePhotosException as e:
+      if not IsTransientError(e):
+        # The session is of no use anymore, the next try starts over.
+        g_state.DeleteUpload(photo.path)
+      raise
+    g_state.DeleteUpload(photo.path)
+    return entry
 
-  def _FetchPhotoTags(self, photo):
-    tags = set()
-    for entry in self.service.GetFeed(photo.remote.GetTagsUri()).entry:
-      tags.add(entry.title.text)
-    return tags
+  def _ReplacePhoto(self, photo, tags):
+    """Updates the remote photo in place, keeping its id and comments.
 
-  def _UploadPhoto(self, url, key, photo, callback):
+    Returns False if the server refused, e.g. because the photo changed
+    since the album feed was read; the caller then deletes and re-inserts.
+    """
+    if photo.remote.GetEditMediaLink() == None:
+      return False
+    try:
+      photo.remote = g_uploads.Run(
+          photo.file.size + UPLOAD_OVERHEAD_BYTES,
+          self.service.UpdatePhotoSimple, photo.remote, photo.path,
+          keywords=tags, checksum=photo.checksum_tag)
+      return True
+    except gdata.photos.service.GooglePhotosException as e:
+      if IsTransientError(e):
+        raise
+      return False
+
+  def _UploadPhoto(self, tasks, url, key, photo, callback):
+    photo.tries += 1
+    retry = False
     try:
       if photo.remote != None:
         if not g_options.force_update:
-          if photo.checksum_tag in self._GetPhotoMd5s():
-            photo.status = Photo.SKIPPED
+          if self._IsUpToDate(photo):
+            self._SetStatus(photo, Photo.SKIPPED)
             return
-          photo_tags = self._FetchPhotoTags(photo)
-          if photo.checksum_tag in photo_tags:
-            photo.status = Photo.SKIPPED
-            return
-        if photo.remote.GetEditLink():
-          self.service.Delete(photo.remote)
+      # The checksum tag is still added for older versions of this script.
       tags = sorted(list(self.album_tags) + [photo.checksum_tag])
-      self.service.InsertPhotoSimple(
-          url, key, '', photo.path, keywords=tags)
-      photo.status = Photo.UPLOADED
+      if photo.remote != None and not g_content.Claim(
+          photo.remote.gphoto_id.text, (self.key, photo.key)):
+        # Moved to another album, see _ReuseRemoteCopy.
+        photo.remote = None
+      if photo.remote != None:
+        if self._ReplacePhoto(photo, tags):
+          self._SetStatus(photo, Photo.UPLOADED)
+          return
+        if photo.remote.GetEditLink():
+          g_requests.Run(1, self.service.Delete, photo.remote)
+          photo.remote = None
+      if photo.remote == None and self._ReuseRemoteCopy(photo, tags):
+        return
+      photo.remote = self._InsertPhoto(url, key, photo, tags)
+      self._SetStatus(photo, Photo.UPLOADED)
     except Exception as e:
-      photo.status = Photo.ERROR
+      if IsTransientError(e) and photo.tries < MAX_UPLOAD_TRIES:
+        retry = True
+      else:
+        photo.status = Photo.ERROR
     finally:
-      callback(photo)
+      if retry:
+        # Tried again once the album's other photos had their turn.
+        tasks.AddTask(self._UploadPhoto, tasks, url, key, photo, callback)
+      else:
+        callback(photo)
 
   class CountersWidget(progressbar.Widget):
     def __init__(self, counters):
@@ -228,137 +1393,359 @@ class Album:
 
   def _PrintStatusLine(self, pbar, counters):
     total = sum([counter.value() for counter in counters.values()])
-    pbar.update(total)
+    with g_display_lock:
+      pbar.update(total)
 
-  def _UploadPhotos(self):
+  def _UploadPhotos(self, uploader, tasks, photos, stale):
     url = '/data/feed/api/user/default/albumid/%s' %  (
         self.remote.gphoto_id.text)
     counters = dict([(name, Counter()) for name in Photo.ALL_STATUS])
-    widgets = ['Syncing [%s]' % self.key,
+    widgets = [uploader.CheckedAlbumsWidget(uploader),
+               ' Syncing [%s]' % self.key,
                ' ', progressbar.Bar(left='[', right=']'),
                ' ', self.CountersWidget(counters),
+               '|', uploader.ParallelismWidget(),
                '|', progressbar.SimpleProgress(),
                '|', progressbar.Percentage(),
                '|', progressbar.AdaptiveETA()]
-    pbar = progressbar.ProgressBar(widgets=widgets, maxval=len(self.photos))
-    pbar.start()
+    with g_display_lock:
+      pbar = progressbar.ProgressBar(widgets=widgets,
+                                     maxval=len(photos) + len(stale),
+                                     fd=uploader.progress_line.Output())
+      pbar.start()
     def callback(photo):
       counters[photo.status].inc()
       self._PrintStatusLine(pbar, counters)
-    for key, photo in self.photos.iteritems():
-      g_workers.AddTask(self._UploadPhoto, url, key, photo, callback)
-    g_workers.Wait()
-    pbar.finish()
+    self._DeletePhotos(tasks, url, stale, callback)
+    for key, photo in photos:
+      tasks.AddTask(self._UploadPhoto, tasks, url, key, photo, callback)
+    return pbar
 
-  def SyncPhotos(self, service):
-    if self.path == None or self.remote == None:
+  def SyncPhotos(self, uploader, on_done=None):
+    """Starts syncing photos on g_workers, calling on_done when finished.
+
+    Creates the album on Google if it has none.
+    """
+    if self.path == None:
+      if on_done:
+        on_done(self)
       return
     self._ScanPhotosFromDisk()
-    self._GetPhotosFromGoogle()
+    if self.remote != None:
+      self._GetPhotosFromGoogle()
+    if self.remote == None:
+      uploader._CreateAlbum(self)
+      # A new album has no photos to list.
+      self.has_remote_photos = True
+    # Photos only on Google have nothing to upload. They are kept unless
+    # --delete_photos.
+    photos = [(key, photo) for key, photo in self.photos.iteritems()
+              if photo.path != None]
+    stale = []
     if g_options.delete_photos:
-      self._DeletePhotos()
-    self._UploadPhotos()
+      # Photos only renamed locally are moved by their new name instead.
+      wanted = set(photo.content_md5 for photo in self.photos.itervalues()
+                   if photo.path != None and photo.remote == None)
+      stale = [photo for photo in self.photos.itervalues()
+               if photo.path == None and
+               g_content.ContentOf(photo.remote.gphoto_id.text) not in wanted]
+    pbar = None
+    def finished():
+      if pbar:
+        with g_display_lock:
+          pbar.finish()
+      self._SaveSyncState()
+      if on_done:
+        on_done(self)
+    tasks = TaskGroup(g_workers, g_options.album_parallelism, finished)
+    pbar = self._UploadPhotos(uploader, tasks, photos, stale)
+    tasks.Close()
 
 
 class GooglePictureUploader:
   def __init__(self):
     self.albums = {}
+    self.checked_albums = Counter()
+    self.progress_line = ProgressLine()
+    self.checkers = ThreadPool(g_options.max_parallelism)
     self.service = gdata.photos.service.PhotosService()
     #self.service.source = 'GooglePictureUploader'
     self.service.email = g_options.email
     self.service.password = g_options.password
+    if g_options.response_cache and g_options.response_cache_mb > 0:
+      self.service.response_cache = gdata.service.ResponseCache(
+          os.path.expanduser(g_options.response_cache),
+          int(g_options.response_cache_mb * (1 << 20)))
     self.service.ProgrammaticLogin()
 
+  def _ListAlbumsFromGoogle(self):
+    """Returns all remote album entries, listing only the changed ones when
+    the previous list is recent enough.
+
+    Listing changes can't tell about albums deleted on Google, hence the
+    whole list is downloaded again every --full_listing_hours.
+    """
+    uri = '/data/feed/api/user/default?kind=album'
+    updated = g_state.GetSetting('albums_updated')
+    listed = g_state.GetSetting('albums_listed')
+    full = (g_options.force_update or updated == None or listed == None or
+            time.time() - float(listed) > g_options.full_listing_hours * 3600)
+    if full:
+      # Until the whole list is in, the next run must list all albums too.
+      g_state.PutSetting('albums_listed', None)
+      g_state.DeleteRemoteAlbums()
+      listed = repr(time.time())
+      albums = {}
+      changed = self.service.GetFeedEntries(uri,
+                                            run=g_requests.FeedRunner())
+    else:
+      albums = dict((entry.gphoto_id.text, entry)
+                    for entry in g_state.GetRemoteAlbums())
+      changed = self.service.GetFeedEntries(
+          '%s&updated-min=%s' % (uri, urllib.quote(updated)),
+          run=g_requests.FeedRunner())
+    count = 0
+    for entry in changed:
+      count += 1
+      albums[entry.gphoto_id.text] = entry
+      g_state.PutRemoteAlbum(entry)
+      # Timestamps of the server in a single format compare as strings.
+      if (entry.updated != None and
+          (updated == None or entry.updated.text > updated)):
+        updated = entry.updated.text
+    g_state.PutSetting('albums_updated', updated)
+    g_state.PutSetting('albums_listed', listed)
+    g_state.Commit()
+    return albums.values(), count
+
   def _GetAlbumsFromGoogle(self):
     print 'Getting list of albums from Google...',
     sys.stdout.flush()
-    count = 0
-    for album in self.service.GetUserFeed(kind='album').entry:
+    entries, changed = self._ListAlbumsFromGoogle()
+    for album in entries:
       key = album.title.text
       if key not in self.albums:
         self.albums[key] = Album(self.service, key)
-      count += 1
       self.albums[key].remote = album
-    print 'found %d albums.' % count
+    print 'found %d albums, %d changed.' % (len(entries), changed)
+
+  def _RescanFolders(self, paths):
+    """Reads the given folders from disk again.
+
+    Returns the albums of folders with photos, and the albums on Google of
+    folders left without any.
+    """
+    albums = []
+    emptied = []
+    for path in paths:
+      files, _ = ScanFolder(path)
+      key = TryStripPrefix(g_options.root, path)
+      # A new Album forgets what was found by the previous sync.
+      album = Album(self.service, key)
+      if key in self.albums:
+        album.remote = self.albums[key].remote
+      album.path = path
+      album.files = files
+      album.num_local_photos = len(files)
+      if files:
+        self.albums[key] = album
+        albums.append(album)
+      elif self.albums.pop(key, None) != None and album.remote != None:
+        emptied.append(album)
+    return albums, emptied
 
   def _ScanAlbumsFromDisk(self):
     print 'Getting list of albums from disk...',
     sys.stdout.flush()
     album_count = 0
-    for root, sub_folders, files in os.walk(g_options.root):
-      photo_count = 0
-      for file in files:
-        if IsPhoto(os.path.join(root, file)):
-          photo_count += 1
-      if photo_count > 0:
-        album_count += 1
-        key = TryStripPrefix(g_options.root, root)
-        if key not in self.albums:
-          self.albums[key] = Album(self.service, key)
-        self.albums[key].path = root
-        self.albums[key].num_local_photos = photo_count
+    for root, files in ScanPhotoTree(g_options.root).iteritems():
+      album_count += 1
+      key = TryStripPrefix(g_options.root, root)
+      if key not in self.albums:
+        self.albums[key] = Album(self.service, key)
+      self.albums[key].path = root
+      self.albums[key].files = files
+      self.albums[key].num_local_photos = len(files)
     print 'found %d albums.' % album_count
 
-  def _DeleteAlbum(self, key):
-    album = self.albums[key]
-    if album.path == None and album.remote != None:
-      del self.albums[key]
-      if album.remote.GetEditLink():
-        self.service.Delete(album.remote)
-
-  def _DeleteStaleAlbums(self):
+  def _DeleteStaleAlbums(self, albums):
     print 'Deleting stale albums from Google...',
     sys.stdout.flush()
-    for key in list(self.albums.keys()):
-      g_workers.AddTask(self._DeleteAlbum, key)
+    entries = [album.remote for album in albums
+               if album.remote != None and album.remote.GetEditLink()]
+    batch_size = self.service.batch_size
+    for first in range(0, len(entries), batch_size):
+      g_workers.AddTask(_DeleteEntries, self.service,
+                        '/data/feed/api/user/default',
+                        entries[first:first + batch_size])
     g_workers.Wait()
+    # Albums not deleted come back with the next whole list.
+    g_state.DeleteRemoteAlbums(album.remote.gphoto_id.text
+                               for album in albums if album.remote != None)
     print 'done.'
 
   def _CreateAlbum(self, album):
-    entry = self.service.InsertAlbum(
+    entry = g_requests.Run(
+        1, self.service.InsertAlbum,
         album.key,  # title
         '',         # summary
         access=g_options.album_access,
         commenting_enabled='false')
-    album.remote = self.service.GetFeed(entry.GetFeedLink().href)
+    album.remote = g_requests.Run(1, self.service.GetFeed,
+                                  entry.GetFeedLink().href)
+
+  class ParallelismWidget(progressbar.Widget):
+    def update(self, pbar):
+      return 'parallel up:%d meta:%d' % (g_uploads.Value(),
+                                         g_requests.Value())
+
+  class CheckedAlbumsWidget(progressbar.Widget):
+    def __init__(self, uploader):
+      progressbar.Widget.__init__(self)
+      self.uploader = uploader
+    def update(self, pbar):
+      return '(%d of %d checked)' % (self.uploader.checked_albums.value(),
+                                     self.uploader.albums_to_check)
+
+  def _AlbumChecked(self, album, to_sync):
+    self.checked_albums.inc()
+    if album.needs_update:
+      to_sync.put(album)
 
-  def _CheckAlbumNeedUpdate(self, album, counter, pbar):
+  def _CheckLocalChanges(self, albums, to_check, to_sync):
+    """Pipeline stage: hashes albums that may have changed."""
+    for album in albums:
+      try:
+        if not g_options.force_update and album.CheckLocalChanges():
+          to_check.put(album)
+          continue
+      except Exception as e:
+        print e
+      self._AlbumChecked(album, to_sync)
+    to_check.put(None)
+
+  def _CheckRemoteChanges(self, album, to_sync):
     try:
-      album.CheckNeedUpdate()
+      album.CheckRemoteChanges()
     except Exception as e:
       print e
     finally:
-      pbar.update(counter.next())
-
-  def _SyncAlbums(self):
-    if not g_options.force_update:
-      widgets = ['Searching for album changes:',
-                 ' ', progressbar.Bar(left='[', right=']'),
-                 '|', progressbar.SimpleProgress(),
-                 '|', progressbar.Percentage(),
-                 '|', progressbar.AdaptiveETA()]
-      pbar = progressbar.ProgressBar(widgets=widgets, maxval=len(self.albums))
-      pbar.start()
-      counter = itertools.count()
-      for key, album in self.albums.iteritems():
-        g_workers.AddTask(self._CheckAlbumNeedUpdate, album, counter, pbar)
-      g_workers.Wait()
-      pbar.finish()
+      self._AlbumChecked(album, to_sync)
+
+  def _DispatchRemoteChecks(self, to_check, to_sync):
+    """Pipeline stage: compares hashed albums with Google in parallel."""
+    while True:
+      album = to_check.get()
+      if album == None:
+        break
+      self.checkers.AddTask(self._CheckRemoteChanges, album, to_sync)
+    self.checkers.Wait()
+    to_sync.put(None)
+
+  def _SyncAlbums(self, albums):
+    """Checks albums for changes while already syncing changed ones."""
+    self.checked_albums = Counter()
+    self.albums_to_check = len(albums)
+    to_check = Queue.Queue(PIPELINE_QUEUE_SIZE)
+    to_sync = Queue.Queue(PIPELINE_QUEUE_SIZE)
+    StartThread(self._CheckLocalChanges, albums, to_check, to_sync)
+    StartThread(self._DispatchRemoteChecks, to_check, to_sync)
+    # Another album is started as soon as its tasks would find a worker
+    # idle, so small albums don't leave workers waiting.
+    syncing = [0]
+    synced = threading.Condition()
+    def album_done(album):
+      with synced:
+        syncing[0] -= 1
+        synced.notify_all()
     print 'Syncing albums...'
-    for key, album in self.albums.iteritems():
-      if album.path != None and album.remote == None:
-        self._CreateAlbum(album)
-      if album.needs_update:
-        album.SyncPhotos(self)
+    while True:
+      album = to_sync.get()
+      if album == None:
+        break
+      g_workers.WaitForIdleWorker()
+      with synced:
+        syncing[0] += 1
+      try:
+        album.SyncPhotos(self, album_done)
+      except Exception as e:
+        # Other albums can still be synced.
+        print 'Could not sync %s: %s' % (album.key, e)
+        album_done(album)
+    with synced:
+      while syncing[0]:
+        synced.wait()
     print 'done.'
 
   def Sync(self):
+    g_content.ClearClaims()
+    self.albums = {}
     self._ScanAlbumsFromDisk()
     self._GetAlbumsFromGoogle()
-    if g_options.delete_albums:
-      self._DeleteStaleAlbums()
+    stale = []
+    for key, album in self.albums.items():
+      if album.path == None:
+        stale.append(album)
+        del self.albums[key]
     if self.albums:
-      self._SyncAlbums()
+      self._SyncAlbums(self.albums.values())
+    # Only now, so photos of renamed folders could move out of them first.
+    if g_options.delete_albums:
+      self._DeleteStaleAlbums(stale)
+
+  def Watch(self):
+    """Syncs everything, then keeps syncing the folders that change.
+
+    Everything is synced again every --full_sync_hours, and whenever
+    changes were too many to tell which folders they were in. A failed sync
+    is tried again after WATCH_RETRY_SECONDS, or with the next changes. If
+    the root folder is deleted or moved, syncing waits for it to be back,
+    rather than deleting every album.
+    """
+    watcher = FolderWatcher(g_options.root)
+    while True:
+      next_full_sync = time.time() + g_options.full_sync_hours * 3600
+      try:
+        self.Sync()
+        PrintTransferStats()
+      except Exception as e:
+        print 'Sync failed: %s' % e
+        next_full_sync = time.time() + WATCH_RETRY_SECONDS
+      print 'Watching %s for changes.' % g_options.root
+      pending = set()
+      while (not watcher.overflowed and not watcher.root_gone and
+             time.time() < next_full_sync):
+        timeout = next_full_sync - time.time()
+        if pending:
+          timeout = min(timeout, WATCH_RETRY_SECONDS)
+        pending.update(watcher.WaitForChanges(g_options.watch_delay,
+                                              timeout))
+        if not pending or watcher.overflowed or watcher.root_gone:
+          continue
+        try:
+          self._SyncFolders(sorted(pending))
+          pending.clear()
+          PrintTransferStats()
+        except Exception as e:
+          print 'Sync failed: %s' % e
+      watcher.overflowed = False
+      if watcher.root_gone:
+        print 'Waiting for %s to be back.' % g_options.root
+        watcher.WaitForRoot(g_options.watch_delay)
+
+  def _SyncFolders(self, paths):
+    """Syncs the albums of the given folders, as Sync would."""
+    g_content.ClearClaims()
+    # Only lists albums changed on Google, see _ListAlbumsFromGoogle.
+    self._GetAlbumsFromGoogle()
+    albums, emptied = self._RescanFolders(paths)
+    if albums:
+      self._SyncAlbums(albums)
+    # Only now, so photos of renamed folders could move out of them first.
+    if emptied and g_options.delete_albums:
+      self._DeleteStaleAlbums(emptied)
+    elif emptied and g_options.delete_photos:
+      self._SyncAlbums(emptied)
 
 
 def main():
@@ -389,13 +1776,98 @@ def main():
   parser.add_option('--delete_photos', action='store_true', default=False,
                     help=('Whether or not keep photo which are not present'
                           ' locally. Use carefully.'))
+  parser.add_option('--upload_duplicates', action='store_true', default=False,
+                    help=('Upload photos even if the same file is already'
+                          ' uploaded in another album. By default they are'
+                          ' only counted as duplicates.'))
+  parser.add_option('--watch', action='store_true', default=False,
+                    help=('Keep running after syncing, and sync folders'
+                          ' again as soon as their photos change (Linux'
+                          ' only).'))
+  parser.add_option('--watch_delay', type='float', default=10,
+                    help=('With --watch, seconds without changes to wait'
+                          ' for before syncing, so a batch of photos is'
+                          ' synced at once.'))
+  parser.add_option('--full_sync_hours', type='float', default=24,
+                    help=('With --watch, everything is synced again every'
+                          ' this many hours, in case changes were missed.'))
   parser.add_option('--parallelism', type='int', default=3,
-                    help='Number of parallel HTTP requests.')
+                    help=('Number of parallel HTTP requests to start with.'
+                          ' It then adapts to how fast the server answers,'
+                          ' separately for uploads and other requests.'))
+  parser.add_option('--max_parallelism', type='int', default=16,
+                    help=('Maximum number of parallel HTTP requests of each'
+                          ' kind.'))
+  parser.add_option('--album_parallelism', type='int', default=0,
+                    help=('Maximum number of parallel HTTP requests for a'
+                          ' single album, so several albums sync at once.'
+                          ' Defaults to --parallelism.'))
+  parser.add_option('--resumable_upload_mb', type='float', default=16,
+                    help=('Photos of at least this many MB are uploaded in'
+                          ' chunks, and continued by the next run if'
+                          ' interrupted.'))
+  parser.add_option('--max_upload_rate', type='float', default=0,
+                    help=('Maximum upload bandwidth in KB/s, shared by all'
+                          ' requests. 0 means unlimited.'))
+  parser.add_option('--max_requests_per_second', type='float', default=0,
+                    help=('Maximum number of HTTP requests started per'
+                          ' second. 0 means unlimited.'))
+  parser.add_option('--limit_schedule', default='',
+                    help=('Changes the two limits above by time of day, e.g.'
+                          ' "08:00=128/2,20:00=0" uploads at 128 KB/s and 2'
+                          ' requests per second from 8am and unlimited from'
+                          ' 8pm.'))
+  parser.add_option('--full_listing_hours', type='float', default=24,
+                    help=('Only albums changed on Google since the previous'
+                          ' run are listed, except every this many hours'
+                          ' when all are, to notice deleted albums.'))
+  parser.add_option('--state_db',
+                    default='~/.cache/google-picture-uploader/state.db',
+                    help=('Local database remembering previous syncs so'
+                          ' unchanged photos and albums are skipped. Set it'
+                          ' empty to disable.'))
+  parser.add_option('--response_cache',
+                    default='~/.cache/google-picture-uploader/responses',
+                    help=('Folder keeping feeds downloaded from Google, only'
+                          ' downloaded again if they changed. Set it empty'
+                          ' to disable.'))
+  parser.add_option('--response_cache_mb', type='float', default=256,
+                    help='Maximum size of --response_cache in MB.')
+  parser.add_option('--gzip_requests', action='store_true', default=False,
+                    help=('Compress large XML requests, such as batch'
+                          ' deletes. Responses are always asked to be'
+                          ' compressed.'))
+  parser.add_option('--metrics_json', default='',
+                    help=('File to write request counts, bytes and latency'
+                          ' percentiles per kind of request to, at the end'
+                          ' of the run and every minute with --watch.'))
+  parser.add_option('--metrics_prometheus', default='',
+                    help=('Same as --metrics_json, in the Prometheus text'
+                          ' format, e.g. for the node exporter textfile'
+                          ' collector.'))
+  parser.add_option('--hash_parallelism', type='int', default=0,
+                    help=('Number of photos hashed in parallel. Guessed from'
+                          ' the disk type by default.'))
   g_options, _ = parser.parse_args()
 
   if g_options.album_access not in ['private', 'public']:
     parser.error('Unknown visibility option: %s' % g_options.album_access)
     return
+  if g_options.watch and not sys.platform.startswith('linux'):
+    parser.error('--watch needs Linux inotify.')
+    return
+  schedule = None
+  if g_options.limit_schedule:
+    try:
+      schedule = ParseLimitSchedule(g_options.limit_schedule)
+    except ValueError as e:
+      parser.error(str(e))
+      return
+
+  for name in ('metrics_json', 'metrics_prometheus'):
+    path = getattr(g_options, name)
+    if path:
+      setattr(g_options, name, os.path.abspath(os.path.expanduser(path)))
 
   g_options.root = os.path.expanduser(g_options.root)
   g_options.root = os.path.abspath(g_options.root) + os.sep
@@ -405,9 +1877,54 @@ def main():
   if not g_options.password:
     g_options.password = getpass.getpass()
 
+  g_options.max_parallelism = max(g_options.max_parallelism,
+                                  g_options.parallelism)
+  if g_options.album_parallelism <= 0:
+    g_options.album_parallelism = g_options.parallelism
+
+  for client in (atom.http.HttpClient, atom.http_core.HttpClient):
+    client.bandwidth_limit = g_bandwidth
+    client.request_rate_limit = g_request_rate
+    client.transfer_stats = g_transfers
+    if g_options.gzip_requests:
+      client.gzip_request_min_bytes = GZIP_REQUEST_MIN_BYTES
+  global g_metrics
+  if g_options.metrics_json or g_options.metrics_prometheus:
+    g_metrics = atom.http_core.RequestMetrics(ClassifyRequest)
+    for client in (atom.http.HttpClient, atom.http_core.HttpClient):
+      client.request_metrics = g_metrics
+    if g_options.watch:
+      StartThread(ExportMetricsPeriodically)
+  if schedule:
+    StartThread(FollowLimitSchedule, schedule)
+  else:
+    SetLimits(g_options.max_upload_rate * 1024,
+              g_options.max_requests_per_second)
+
   global g_workers
-  g_workers = ThreadPool(g_options.parallelism)
-  GooglePictureUploader().Sync()
+  g_workers = ThreadPool(g_options.max_parallelism, queue_size=0)
+  global g_requests
+  g_requests = AdaptiveLimit(g_options.parallelism, g_options.max_parallelism)
+  global g_uploads
+  g_uploads = AdaptiveLimit(g_options.parallelism, g_options.max_parallelism)
+  global g_hashers
+  g_hashers = HashPool(g_options.hash_parallelism or
+                       GuessHashParallelism(g_options.root))
+  global g_state
+  g_state = SyncState(os.path.expanduser(g_options.state_db))
+  global g_content
+  g_content = ContentIndex()
+  g_content.Load(g_state)
+  try:
+    if g_options.watch:
+      GooglePictureUploader().Watch()
+    else:
+      GooglePictureUploader().Sync()
+      PrintTransferStats()
+  finally:
+    g_state.Close()
+    if g_metrics is not None:
+      ExportMetrics()
 
 
 if __name__ == "__main__":